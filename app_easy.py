@@ -1,10 +1,32 @@
 import streamlit as st
 import json
 import os
-import yaml
 from openai import OpenAI
 import datetime
 import re
+import textwrap
+import time
+import hashlib
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
+from llm_client import estimate_tokens, get_rate_limiter
+
+# orjson 对 CJK 重载荷的解析/序列化快 2-5 倍且原生输出紧凑 UTF-8；未安装时退回 stdlib
+try:
+    import orjson
+
+    def json_loads(s):
+        return orjson.loads(s)
+
+    def json_dumps_compact(obj):
+        return orjson.dumps(obj).decode("utf-8")
+except ImportError:
+    def json_loads(s):
+        return json.loads(s)
+
+    def json_dumps_compact(obj):
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+
 
 def log(msg):
     timestamp = datetime.datetime.now().strftime("%H:%M:%S")
@@ -23,8 +45,62 @@ if not api_key:
     st.stop()
 base_url = os.getenv("OPENAI_BASE_URL")
 
-client = OpenAI(api_key=api_key, base_url=base_url)
 MODEL_NAME = "gpt-4o-mini"
+# 模型级联：0/1 意图判断这类琐碎分类不值得主力模型的延迟与价格
+INTENT_MODEL = os.getenv("INTENT_MODEL", "gpt-4.1-nano")
+
+
+@st.cache_resource(show_spinner=False)
+def get_openai_client():
+    """
+    复用单个 OpenAI 客户端：Streamlit 每次重跑脚本，模块级裸 OpenAI() 会反复重建连接池。
+    调大 httpx keepalive 池并尽量启用 HTTP/2，省掉每请求的 TLS 握手开销。
+    """
+    import httpx
+    limits = httpx.Limits(max_keepalive_connections=32, max_connections=64, keepalive_expiry=120)
+    timeout = httpx.Timeout(60.0, connect=5.0)
+    try:
+        http_client = httpx.Client(limits=limits, timeout=timeout, http2=True)
+    except ImportError:
+        # http2 需要可选依赖 h2，未安装时退回 HTTP/1.1
+        http_client = httpx.Client(limits=limits, timeout=timeout)
+    # SDK 重试关掉（默认 max_retries=2），由调用方自己的重试循环负责：
+    # call_llm 与 Layer2 的直连流式请求各带一层退避重试，避免两层相乘后
+    # 最坏情况一次调用变成 6 次请求、数倍超时等待
+    return OpenAI(api_key=api_key, base_url=base_url, http_client=http_client, max_retries=0)
+
+
+client = get_openai_client()
+
+
+@st.cache_resource(show_spinner=False)
+def get_executor():
+    """进程内共享线程池，用于并行化网络绑定的 LLM 调用（Streamlit 重跑不重建）。"""
+    return ThreadPoolExecutor(max_workers=4)
+
+
+# 精确匹配响应缓存：Streamlit 重跑会把相同输入重新发给 LLM，
+# 命中缓存微秒级返回，省去重复付费往返
+LLM_CACHE_TTL_SECONDS = 3600
+LLM_CACHE_MAX_ENTRIES = 512
+
+
+@st.cache_resource(show_spinner=False)
+def get_llm_cache():
+    return {}
+
+
+def _llm_cache_put(cache_key, result):
+    """写入缓存并做容量上限淘汰：dict 插入序即时间序，满了先淘汰最老的一条。"""
+    cache = get_llm_cache()
+    if len(cache) >= LLM_CACHE_MAX_ENTRIES:
+        cache.pop(next(iter(cache)))
+    cache[cache_key] = (result, time.time())
+
+
+def _llm_cache_key(system_prompt, prompt, json_mode, temperature, model=MODEL_NAME):
+    raw = f"{model}|{temperature}|{json_mode}|{system_prompt}|{prompt}"
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
 
 # --- Memory Layer (NEW) ---
 class MemoryLayer:
@@ -32,6 +108,11 @@ class MemoryLayer:
     
     def __init__(self, llm_caller):
         self.llm_caller = llm_caller
+        # 记忆上下文缓存：每轮被 Layer 1/2/3 各读一次，但只在记忆变更时需要重建
+        self._version = 0
+        self._ctx_cache = (-1, "")
+        # unresolved_obstacles 的去重影子集合：成员判断 O(1)，列表本身保持插入序
+        self._obstacle_set = set()
         self.memory = {
             "intent_to_pay_today": None,  # 1 = 今天会还，0 = 今天不会还
             "payment_refusals": 0,
@@ -78,10 +159,14 @@ class MemoryLayer:
 直接输出数字（0 或 1）。"""
         
         try:
+            # 单字符分类走 nano 级模型 + max_tokens=2：比主力模型快且便宜一个量级
             result = self.llm_caller(
                 user_msg,
                 system_prompt=system_prompt,
-                json_mode=False
+                json_mode=False,
+                temperature=0.0,
+                max_tokens=2,
+                model=INTENT_MODEL
             )
             intent = int(result.strip())
             return 1 if intent == 1 else 0
@@ -91,18 +176,43 @@ class MemoryLayer:
     
     def extract_from_dialogue(self, user_msg: str, conversation_history: list):
         """从用户消息中提取关键信息"""
-        # ========== 第一步：LLM 意图判断 ==========
-        intent = self.detect_payment_intent(user_msg)
+        # 意图判断并入结构化提取：一次 JSON 调用同时产出意图与八类字段，
+        # 每轮记忆更新从两次 RTT 降为一次；提取失败时退回独立的意图判断调用
+        extracted = self._extract_with_llm(user_msg)
+        if extracted is not None and extracted.get("intent_to_pay_today") in (0, 1):
+            intent = int(extracted["intent_to_pay_today"])
+        else:
+            intent = self.detect_payment_intent(user_msg)
         self.memory["intent_to_pay_today"] = intent
-        
+
         # 如果意图是不还，计数拒付
         if intent == 0:
             self.memory["payment_refusals"] += 1
-        
-        # ========== 第二步到第五步：LLM 智能提取（能力评估、原因分类、具体理由、障碍） ==========
-        self._extract_with_llm(user_msg)
-        
+
+        if extracted:
+            self._record_refusal(extracted.get("ability_score", ""), extracted.get("reason_detail", ""))
+
+        self._version += 1
         log(f"Memory updated - Intent:{intent}, Date:{self.memory['payment_date_confirmed']}, Amount:{self.memory['payment_amount_confirmed']}, Type:{self.memory['payment_type_confirmed']}")
+
+    def _record_refusal(self, ability, reason_detail):
+        """按本轮意图与能力归类一次拒绝并写入拒绝历史。"""
+        if not reason_detail:
+            return
+        refusal_type = "delay"  # 默认延迟
+        if ability == "zero":
+            refusal_type = "no_ability"  # 无能力还款
+        elif self.memory.get("intent_to_pay_today") == 0:
+            refusal_type = "refuse"  # 拒绝还款
+
+        timestamp = datetime.datetime.now().strftime("%H:%M:%S")
+        refusal_entry = {
+            "timestamp": timestamp,
+            "type": refusal_type,
+            "reason": reason_detail[:100]  # 截断到 100 字
+        }
+        self.memory["refusal_history"].append(refusal_entry)
+        log(f"Refusal recorded: {refusal_entry}")
     
     def _extract_with_llm(self, user_msg: str):
         """
@@ -110,6 +220,11 @@ class MemoryLayer:
         """
         system_prompt = """你是信息提取专家。根据用户的话语，智能提取以下所有信息：
 
+0. intent_to_pay_today: 用户对"今天还钱"的意图
+   - 1：用户表示今天会还钱（或者至少没有明确拒绝）
+   - 0：用户明确表示今天不会还钱（没钱、明天再说、有其他障碍等）
+   例："我今天下午3点给你还" → 1；"现在没钱，明天再说" → 0；"我会尽快还给你" → 1
+
 1. ability_score: 用户还钱的能力
    - "full": 用户有充足能力还全额
    - "partial": 用户只能部分还钱
@@ -143,6 +258,7 @@ class MemoryLayer:
 
 必须返回严格的 JSON 格式，例如：
 {
+  "intent_to_pay_today": 0,
   "ability_score": "partial",
   "reason_category": "unemployment",
   "reason_detail": "最近失业，还在找工作中，下周有面试",
@@ -161,7 +277,7 @@ class MemoryLayer:
                 system_prompt=system_prompt,
                 json_mode=True
             )
-            data = json.loads(result)
+            data = json_loads(result)
             
             # 1. 更新能力评估
             ability = data.get("ability_score", "")
@@ -178,7 +294,8 @@ class MemoryLayer:
             if reason in ["unemployment", "illness", "forgot", "malicious_delay", "other"]:
                 self.memory["reason_category"] = reason
             
-            # 3. 累积更新具体理由（去重）
+            # 3. 累积更新具体理由（去重）；拒绝历史的记录移到调用方，
+            #    因为拒绝类型依赖与本方法并行求得的本轮意图
             reason_detail = data.get("reason_detail", "")
             if reason_detail:
                 existing = self.memory.get("reason_detail", "")
@@ -188,29 +305,13 @@ class MemoryLayer:
                         self.memory["reason_detail"] = (existing + "；" + reason_detail)[:500]
                 else:
                     self.memory["reason_detail"] = reason_detail
-                
-                # ======== 新增：记录到拒绝历史 ========
-                # 根据能力和意图判断拒绝类型
-                refusal_type = "delay"  # 默认延迟
-                if ability == "zero":
-                    refusal_type = "no_ability"  # 无能力还款
-                elif self.memory.get("intent_to_pay_today") == 0:
-                    refusal_type = "refuse"  # 拒绝还款
-                
-                timestamp = datetime.datetime.now().strftime("%H:%M:%S")
-                refusal_entry = {
-                    "timestamp": timestamp,
-                    "type": refusal_type,
-                    "reason": reason_detail[:100]  # 截断到 100 字
-                }
-                self.memory["refusal_history"].append(refusal_entry)
-                log(f"Refusal recorded: {refusal_entry}")
-            
-            # 4. 累积更新障碍列表（去重）
+
+            # 4. 累积更新障碍列表（影子集合去重，免去逐项线性扫描）
             obstacles = data.get("obstacles", [])
             if isinstance(obstacles, list):
                 for obstacle in obstacles:
-                    if obstacle not in self.memory["unresolved_obstacles"]:
+                    if obstacle not in self._obstacle_set:
+                        self._obstacle_set.add(obstacle)
                         self.memory["unresolved_obstacles"].append(obstacle)
             
             # 5. 更新还款日期（仅在之前未确认时）
@@ -234,8 +335,10 @@ class MemoryLayer:
                 self.memory["extension_requested"] = True
             
             log(f"LLM extraction completed - ability:{ability}, reason:{reason}, date:{payment_date}, amount:{payment_amount}, type:{payment_type}, extension:{extension}")
+            return data
         except Exception as e:
             log(f"LLM extraction error: {e}")
+            return None
     
     def parse_history_summary(self, history_text: str):
         """
@@ -267,12 +370,16 @@ class MemoryLayer:
         
         try:
             log(f"Starting to parse history summary, text length: {len(history_text)}")
+            # 提取类任务用 temperature=0 + 精确匹配缓存：同一段历史文本（Reset Session
+            # 后重建会话是常态）不再重付一次长上下文解析调用
             result = self.llm_caller(
                 history_text,
                 system_prompt=system_prompt,
-                json_mode=True
+                json_mode=True,
+                temperature=0.0,
+                use_cache=True
             )
-            data = json.loads(result)
+            data = json_loads(result)
             
             # 更新历史分析结果到记忆
             self.memory["history_summary"] = data.get("summary", "")
@@ -283,77 +390,165 @@ class MemoryLayer:
             # 如果当前的失约次数还是0，用历史的
             if self.memory["broken_promises"] == 0:
                 self.memory["broken_promises"] = self.memory["history_broken_promises"]
-            
+            self._version += 1
+
             log(f"History parsed successfully: summary_length={len(data.get('summary', ''))}, broken_promises={data.get('broken_promises', 0)}")
-        except json.JSONDecodeError as e:
+        except ValueError as e:
             log(f"History parse JSON error: {e}")
         except Exception as e:
             log(f"History parse error: {type(e).__name__}: {e}")
     
     def get_memory_context(self) -> str:
-        """生成记忆摘要，用于传给 Layer1 和 Layer2"""
-        intent_text = "有意愿今天还" if self.memory.get('intent_to_pay_today') == 1 else "无意愿今天还"
+        """生成记忆摘要，用于传给 Layer1 和 Layer2（按版本号缓存，变更才重建）"""
+        if self._ctx_cache[0] == self._version:
+            return self._ctx_cache[1]
+        # 重建路径上把 self.memory 绑定为局部变量，省去十余次属性查找
+        mem = self.memory
+        intent_text = "有意愿今天还" if mem.get('intent_to_pay_today') == 1 else "无意愿今天还"
         
         # 收敛性进度
         convergence_status = f"""
 【关键信息收敛进度】
-✓ 还款能力: {'已确认' if self.memory.get('has_ability_confirmed') else '未确认'} ({self.memory.get('ability_score', '未知')})
-✓ 还款时间: {self.memory.get('payment_date_confirmed') or '未确认'}
-✓ 还款金额: {self.memory.get('payment_amount_confirmed') or '未确认'}
-✓ 付款方式: {self.memory.get('payment_type_confirmed') or '未确认'}
-✓ 展期请求: {'是' if self.memory.get('extension_requested') else '否'}
+✓ 还款能力: {'已确认' if mem.get('has_ability_confirmed') else '未确认'} ({mem.get('ability_score', '未知')})
+✓ 还款时间: {mem.get('payment_date_confirmed') or '未确认'}
+✓ 还款金额: {mem.get('payment_amount_confirmed') or '未确认'}
+✓ 付款方式: {mem.get('payment_type_confirmed') or '未确认'}
+✓ 展期请求: {'是' if mem.get('extension_requested') else '否'}
 """
         
         # 构建当前画像
         summary = f"""
 【客户当前画像】
-- 今日意图: {intent_text} (intent={self.memory.get('intent_to_pay_today')})
-- 拒付次数: {self.memory.get('payment_refusals', 0)}
-- 失约次数: {self.memory.get('broken_promises', 0)}
-- 能力评估: {self.memory.get('ability_score', '未知')}
-- 原因分类: {self.memory.get('reason_category', '未知')}
-- 具体理由: {self.memory.get('reason_detail', '暂无')}
-- 待解决障碍: {', '.join(self.memory.get('unresolved_obstacles', [])) or '无'}
+- 今日意图: {intent_text} (intent={mem.get('intent_to_pay_today')})
+- 拒付次数: {mem.get('payment_refusals', 0)}
+- 失约次数: {mem.get('broken_promises', 0)}
+- 能力评估: {mem.get('ability_score', '未知')}
+- 原因分类: {mem.get('reason_category', '未知')}
+- 具体理由: {mem.get('reason_detail', '暂无')}
+- 待解决障碍: {', '.join(mem.get('unresolved_obstacles', [])) or '无'}
 
 {convergence_status}
 """
         
         # 如果有历史分析，添加进来
-        if self.memory.get('history_summary'):
+        if mem.get('history_summary'):
             summary += f"""
 
 【历史分析】
-- 摘要: {self.memory.get('history_summary', '暂无')}
-- 历史失约: {self.memory.get('history_broken_promises', 0)} 次
-- 历史原因: {self.memory.get('history_reason_category', '未知')}
-- 历史能力: {self.memory.get('history_ability_score', '未知')}
+- 摘要: {mem.get('history_summary', '暂无')}
+- 历史失约: {mem.get('history_broken_promises', 0)} 次
+- 历史原因: {mem.get('history_reason_category', '未知')}
+- 历史能力: {mem.get('history_ability_score', '未知')}
 """
         
-        return summary.strip()
-    
+        context = summary.strip()
+        self._ctx_cache = (self._version, context)
+        return context
+
+    def save(self, path):
+        """记忆落盘（orjson 可用时走 C 实现），回头客换会话不必重付历史解析调用。"""
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(json_dumps_compact(self.memory))
+
+    def load(self, path) -> bool:
+        """从磁盘恢复记忆；文件缺失/损坏时保持初始状态并返回 False。"""
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json_loads(f.read())
+        except (OSError, ValueError) as e:
+            log(f"Memory load skipped ({path}): {e}")
+            return False
+        if not isinstance(data, dict):
+            return False
+        self.memory.update(data)
+        self._obstacle_set = set(self.memory.get("unresolved_obstacles") or [])
+        self._version += 1
+        return True
+
     def to_dict(self):
         return self.memory.copy()
 
-def load_config(config_path):
-    with open(config_path, 'r') as f:
-        return yaml.safe_load(f)
 
-def call_llm(prompt, system_prompt="You are a helpful assistant.", json_mode=False):
-    """调用 LLM，带简单重试和 JSON 模式支持。"""
+def memory_persist_path(config, customer_profile):
+    """配置了 memory_persist_dir 时返回该客户的记忆文件路径（默认不持久化）。"""
+    persist_dir = config.get("memory_persist_dir")
+    if not persist_dir:
+        return None
+    os.makedirs(persist_dir, exist_ok=True)
+    key = hashlib.sha256(str(customer_profile.get("name", "unknown")).encode("utf-8")).hexdigest()[:12]
+    return os.path.join(persist_dir, f"{key}.json")
+
+@st.cache_data(show_spinner=False)
+def load_config(config_path, mtime=None):
+    # 延迟导入：yaml 只在这里用，且本函数有 st.cache_data，冷启动后几乎不再执行；
+    # libyaml C 实现解析快 5-10 倍，未编译进 pyyaml 时退回纯 Python SafeLoader。
+    # mtime 参与缓存键：配置文件被编辑后缓存自动失效，无需重启会话
+    import yaml
+    loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+    # 二进制读取：跳过 Python 层的文本解码，交给解析器自己处理编码
+    with open(config_path, 'rb') as f:
+        return yaml.load(f, Loader=loader)
+
+
+@st.cache_data(show_spinner=False)
+def parse_profile(profile_str: str):
+    # 按文本内容缓存画像解析：rerun 之间字符串不变时直接取缓存副本
+    # （cache_data 每次返回拷贝，后续写入 DPD 不会污染缓存）
+    return json_loads(profile_str)
+
+
+@st.cache_data(ttl=60, show_spinner=False)
+def list_config_files():
+    # scandir 复用 DirEntry、免去二次 stat；排序让 selectbox 顺序跨平台稳定
+    return sorted(e.name for e in os.scandir("configs")
+                  if e.is_file() and e.name.endswith(".yaml"))
+
+def call_llm(prompt, system_prompt="You are a helpful assistant.", json_mode=False, stream=False,
+             temperature=0.7, use_cache=False, max_tokens=None, model=None):
+    """调用 LLM，带简单重试、JSON 模式、流式、模型路由和精确匹配缓存支持。"""
+    model = model or MODEL_NAME
+    cache_key = None
+    if use_cache:
+        cache_key = _llm_cache_key(system_prompt, prompt, json_mode, temperature, model)
+        cached = get_llm_cache().get(cache_key)
+        if cached:
+            if time.time() - cached[1] < LLM_CACHE_TTL_SECONDS:
+                log("LLM cache hit, skipping API call.")
+                return cached[0]
+            # 过期条目读到即删，否则只会被新写入挤出去之前一直占着内存
+            get_llm_cache().pop(cache_key, None)
+
     retries = 2
     for attempt in range(retries + 1):
         try:
+            # 并行化后的调用突发不能超过账号 RPM/TPM：每次实际出网（含重试）
+            # 前过一遍全局限速器，未配置上限时是空操作
+            get_rate_limiter().acquire(estimate_tokens(system_prompt) + estimate_tokens(prompt))
             kwargs = {
-                "model": MODEL_NAME,
+                "model": model,
                 "messages": [
                     {"role": "system", "content": system_prompt},
                     {"role": "user", "content": prompt}
                 ],
-                "temperature": 0.7
+                "temperature": temperature
             }
             if json_mode:
                 kwargs["response_format"] = {"type": "json_object"}
-            log(f"Calling LLM... Model: {MODEL_NAME}, JSON_Mode: {json_mode}")
+            if max_tokens is not None:
+                kwargs["max_tokens"] = max_tokens
+            log(f"Calling LLM... Model: {model}, JSON_Mode: {json_mode}, Stream: {stream}")
+            if stream:
+                # 流式：边收边拼接，首 token 一到就开始累积，减少整段等待
+                kwargs["stream"] = True
+                parts = []
+                for chunk in client.chat.completions.create(**kwargs):
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        parts.append(chunk.choices[0].delta.content)
+                log("LLM Stream finished.")
+                result = "".join(parts).strip()
+                if cache_key:
+                    _llm_cache_put(cache_key, result)
+                return result
             response = client.chat.completions.create(**kwargs)
             log("LLM Response received.")
             # 记录 tokens 使用情况（如可用）
@@ -366,7 +561,10 @@ def call_llm(prompt, system_prompt="You are a helpful assistant.", json_mode=Fal
                     log(f"LLM tokens - prompt:{prompt_tokens}, completion:{completion_tokens}, total:{total_tokens}")
             except Exception as _:
                 pass
-            return response.choices[0].message.content.strip()
+            result = response.choices[0].message.content.strip()
+            if cache_key:
+                _llm_cache_put(cache_key, result)
+            return result
         except Exception as e:
             log(f"LLM Error: {e}")
             if attempt < retries:
@@ -379,60 +577,254 @@ def call_llm(prompt, system_prompt="You are a helpful assistant.", json_mode=Fal
             st.error(f"LLM Error: {e}")
             return "Error"
 
+def iter_json_string_field(chunks, field="response", sink=None):
+    """
+    增量解析流式 JSON：在 delta 流中定位 `"field": "` 之后，逐字符产出字符串值，
+    处理转义（\\n、\\"、\\uXXXX 等），遇到未转义的结束引号即停止产出。
+    sink 传入 list 时，流结束后完整原文会被 append 进去，供调用方二次解析。
+    """
+    buffer = []
+    state = "search"  # search -> colon -> value -> done
+    tail = ""
+    escape = False
+    unicode_buf = None
+    marker = f'"{field}"'
+    for chunk in chunks:
+        if not chunk:
+            continue
+        buffer.append(chunk)
+        for ch in chunk:
+            if state == "done":
+                continue
+            if state == "search":
+                tail = (tail + ch)[-len(marker):]
+                if tail == marker:
+                    state = "colon"
+                continue
+            if state == "colon":
+                if ch == '"':
+                    state = "value"
+                elif ch not in ': \t\r\n':
+                    state = "search"  # 不是字符串值，回到搜索
+                continue
+            # state == "value"
+            if unicode_buf is not None:
+                unicode_buf += ch
+                if len(unicode_buf) == 4:
+                    try:
+                        yield chr(int(unicode_buf, 16))
+                    except ValueError:
+                        pass
+                    unicode_buf = None
+                continue
+            if escape:
+                escape = False
+                if ch == 'u':
+                    unicode_buf = ""
+                else:
+                    yield {'n': '\n', 't': '\t', 'r': '\r', 'b': '\b', 'f': '\f'}.get(ch, ch)
+                continue
+            if ch == '\\':
+                escape = True
+            elif ch == '"':
+                state = "done"
+            else:
+                yield ch
+    if sink is not None:
+        sink.append("".join(buffer))
+
+
+# Layer 3 前置廉价分诊：明显的拒绝/还款信号在本地微秒级判定，
+# 只有模糊的轮次才花一次完整的 LLM 评估
+# main() 每次重跑都会重建内联的关键字检查，预编译为模块级常量
+# 锚定在【回款可能性】字段上再取判定值：裸匹配 "LOW" 会被评估文本里
+# 复读的 "HIGH/MEDIUM/LOW" 枚举误触，引发无谓的 Layer 1 更新调用
+_PROB_PAT = re.compile(
+    r"(?:【回款可能性】|\"probability\"\s*:\s*\")\s*(HIGH|MEDIUM|LOW)")
+
+
+def is_low_probability(evaluation_output):
+    m = _PROB_PAT.search(evaluation_output or "")
+    return bool(m and m.group(1) == "LOW")
+_JSON_OBJ_PAT = re.compile(r"\{[\s\S]*\}")
+
+# 不进入 Layer 2 提示词的配置键：提示词本体、元数据、运行期调优旋钮
+_CONFIG_PROMPT_EXCLUDE = frozenset({
+    "system_prompt", "name", "description", "version", "integration", "notes",
+    "max_history_messages", "request_timeout_seconds", "layer3_wait_seconds",
+    "history_window_turns", "history_summary_threshold",
+    "analysis_render_window", "chat_render_window",
+})
+
+# 基础提示里与 JSON 输出约定冲突的片段，构建静态前缀时一趟剔除
+_PROMPT_NOISE_PAT = re.compile(r"You must output a JSON object|Output Format")
+_TRIAGE_LOW_PAT = re.compile(r"不还|没钱|还不了|付不了|别烦我|投诉|起诉|骚扰|报警|拉黑|凭什么")
+_TRIAGE_HIGH_PAT = re.compile(r"现在就还|马上转|正在转账|已经还了|这就去还|立刻还|现在转")
+
+
+def cheap_triage(user_msg):
+    """返回 "HIGH"/"LOW" 表示规则直接判定；返回 None 回落到 LLM 评估。"""
+    if not user_msg:
+        return None
+    if _TRIAGE_HIGH_PAT.search(user_msg):
+        return "HIGH"
+    if _TRIAGE_LOW_PAT.search(user_msg):
+        return "LOW"
+    return None
+
+
+def append_message(role, content):
+    """追加聊天消息，并同步维护逐条紧凑 JSON 片段：
+    Layer 3 每轮的窗口序列化由"整窗 re-dump"变成切片 + join，摊还 O(1)。"""
+    st.session_state.messages.append({"role": role, "content": content})
+    st.session_state.msg_frags.append(json_dumps_compact({"role": role, "content": content}))
+
+
+def trim_history(history, k=8):
+    """返回最近 k 轮（2k 条）消息：输入 token 随对话线性增长，prefill 延迟近似平方增长。"""
+    if not isinstance(history, list):
+        return []
+    return history[-2 * k:]
+
+
+def build_opening_instruction(customer_profile):
+    """首轮开场白的执行指令：DPD≥0 时要求当天闭环。预热与自动初始化共用。"""
+    instruction = (
+        "Start the conversation naturally. If there's history with the customer, acknowledge it and continue. If new customer, introduce yourself and explain your role."
+    )
+    if isinstance(customer_profile.get("DPD"), int) and customer_profile["DPD"] >= 0:
+        instruction += " Also, DPD≥0: ensure a same-day repayment closure (full payment, or partial + a specific time today, or, if eligible, same-day extension)."
+    return instruction
+
+
+# 画像 dict 在同一轮里会被 Layer 1/Layer 3 各自序列化；按对象身份做单槽 memo，
+# 一轮只 dumps 一次（每次 rerun 重新 json.loads 出的新对象自然换新槽）
+_profile_json_memo = (None, "")
+
+
+def profile_json(customer_profile):
+    global _profile_json_memo
+    if _profile_json_memo[0] is not customer_profile:
+        _profile_json_memo = (customer_profile, json_dumps_compact(customer_profile))
+    return _profile_json_memo[1]
+
+
 # --- Agent Layers (Adapted for Streamlit) ---
 
+# 各层 system prompt 均为静态文本，提升为模块级常量：
+# 每轮逐字节一致，OpenAI 自动 prompt caching 才能命中前缀。
+LAYER1_INIT_SYSTEM_PROMPT = "你是催收策略经理。根据客户信息、历史记录以及公司的基础配置规则，制定今天的催收策略。"
+
+LAYER1_UPDATE_SYSTEM_PROMPT = """你是催收策略经理。Layer 3 评估层给出了当前策略的效果评估和改进建议，请根据建议调整策略。
+
+重要：Layer 3 的建议包含两部分关键信息：
+1. 回款可能性评估（HIGH/MEDIUM/LOW）
+2. 信息收敛进度分析（哪些信息已收集，哪些还缺失）
+
+你需要根据这些信息，调整策略的：
+- 沟通基调和压力等级
+- 【多步收敛路径】的优先级（优先收集缺失的关键信息）
+- 话术和施压手段
+"""
+
+
 class Layer1StrategyManager:
     def __init__(self, config, history_logs):
         self.config = config
         self.history_logs = history_logs
+        # history_logs 在会话内不变，序列化一次复用，避免每轮重复 json.dumps
+        self._history_json = json_dumps_compact(history_logs)
 
     def generate_initial_strategy(self, customer_profile):
-        system_prompt = "你是催收策略经理。根据客户信息、历史记录以及公司的基础配置规则，制定今天的催收策略。"
+        # 静态说明在前、动态的画像/历史压到末尾：与 system prompt 连成逐字节稳定的
+        # 前缀，同画像重试/重跑时才能命中 OpenAI 自动 prompt cache
+        system_prompt = LAYER1_INIT_SYSTEM_PROMPT
         user_prompt = f"""
-        客户资料：{json.dumps(customer_profile, ensure_ascii=False)}
-        客户资料将有助于你分析客户当前的经济能力
-        
-        历史记录：{json.dumps(self.history_logs, ensure_ascii=False)}
-        基于此记忆体，我们能总结出我们每天与客户交流的内，客户的还款意愿与还款能力吗？客户拒绝还款的理由是否合理
+        客户资料将有助于你分析客户当前的经济能力。
+        基于历史记录这一记忆体，我们能总结出我们每天与客户交流的内，客户的还款意愿与还款能力吗？客户拒绝还款的理由是否合理
         注意，历史记录是非常重要的资料来源，说明我们已经与客户交流过了，但客户可能因为各种原因还没有还钱，现在希望是延续之前的对话，继续给客户施加压力。
 
         *** 关键约束 ***
         目标：尽快拿回钱。
 
         请按以下格式输出：
-        
+
         【历史分析】
         （在此处简要分析客户昨天的态度、承诺、还款能力和意愿）
-        
+
         【今日临时催收策略】
         1. 沟通基调：...
         2. 重点强调的内容：...
         step0: 查阅聊天历史，延续上次的聊天，询问客户之前阻碍还款的因素是否已经消除，今天是否有计划还钱
-       
-        
+
+
         ⚠️ 注意：每一步都要等客户明确回答后再进入下一步，不要一次问太多问题。
+
+        客户资料：{profile_json(customer_profile)}
+
+        历史记录：{self._history_json}
         """
-        return call_llm(user_prompt, system_prompt)
+        return call_llm(user_prompt, system_prompt, stream=True, use_cache=True,
+                        max_tokens=int(self.config.get("max_tokens_layer1_init", 600)))
 
-    def update_strategy(self, current_strategy, feedback, chat_history, customer_profile, layer3_advice):
-        system_prompt = """你是催收策略经理。Layer 3 评估层给出了当前策略的效果评估和改进建议，请根据建议调整策略。
-        
-重要：Layer 3 的建议包含两部分关键信息：
-1. 回款可能性评估（HIGH/MEDIUM/LOW）
-2. 信息收敛进度分析（哪些信息已收集，哪些还缺失）
+    def generate_initial_strategy_with_opening(self, customer_profile, opening_instruction):
+        """首轮把"生成策略 + 开场白"合并为一次调用（原先是 Layer 1 + Layer 2 串行两问）。
 
-你需要根据这些信息，调整策略的：
-- 沟通基调和压力等级
-- 【多步收敛路径】的优先级（优先收集缺失的关键信息）
-- 话术和施压手段
-"""
+        返回 (strategy, opening_message)；JSON 解析失败时返回 (原始文本, None)，
+        由调用方回退到旧的 Layer 2 开场路径。后续轮次仍保持 Layer 1/2 分离。
+        """
+        system_prompt = LAYER1_INIT_SYSTEM_PROMPT
         user_prompt = f"""
-        
-客户资料：{json.dumps(customer_profile, ensure_ascii=False)}
-历史记录：{json.dumps(self.history_logs, ensure_ascii=False)}
-当前会话历史：{json.dumps(chat_history, ensure_ascii=False, indent=2)}
+        客户资料将有助于你分析客户当前的经济能力。
+        基于历史记录这一记忆体，我们能总结出我们每天与客户交流的内，客户的还款意愿与还款能力吗？客户拒绝还款的理由是否合理
+        注意，历史记录是非常重要的资料来源，说明我们已经与客户交流过了，但客户可能因为各种原因还没有还钱，现在希望是延续之前的对话，继续给客户施加压力。
+
+        *** 关键约束 ***
+        目标：尽快拿回钱。
+
+        在制定策略之外，你还要以一线催收执行者的口吻写出发给客户的第一条消息。
+
+        请严格输出 JSON（不要输出其他内容），包含两个键：
+        {{"strategy": "【历史分析】...\\n【今日临时催收策略】1. 沟通基调：... 2. 重点强调的内容：... step0: 查阅聊天历史，延续上次的聊天，询问客户之前阻碍还款的因素是否已经消除，今天是否有计划还钱",
+          "opening_message": "发给客户的第一条消息"}}
 
-Layer 3 评估与建议（包含收敛性分析）：
+        开场要求：{opening_instruction}
+
+        客户资料：{profile_json(customer_profile)}
+
+        历史记录：{self._history_json}
+        """
+        raw = call_llm(user_prompt, system_prompt, json_mode=True, use_cache=True,
+                       max_tokens=int(self.config.get("max_tokens_layer1_init", 600)) + 300)
+        try:
+            data = json_loads(raw)
+            strategy = data.get("strategy") or ""
+            opening = data.get("opening_message") or None
+            if strategy:
+                return strategy, opening
+        except (ValueError, TypeError, AttributeError):
+            pass
+        return raw, None
+
+    def summarize_old(self, old_messages):
+        """把滑出窗口的早期对话一次性压缩成简短摘要，供 Layer 2/3 替代原文。"""
+        system_prompt = "你是对话压缩器。把催收对话的早期部分压缩为150字以内的中文摘要，保留：客户的承诺/拒绝、给出的理由、已确认的还款信息。只输出摘要。"
+        user_prompt = json_dumps_compact(
+            [{"role": m.get("role"), "content": m.get("content")} for m in old_messages]
+        )
+        return call_llm(user_prompt, system_prompt, temperature=0.0, use_cache=True,
+                        max_tokens=int(self.config.get("max_tokens_summary", 250)))
+
+    def update_strategy(self, current_strategy, layer3_advice, latest_user_msg, customer_profile):
+        # Layer 3 的建议已经蒸馏了完整对话与历史记录，这里不再重复喂原始转录，
+        # 只带客户资料 + 最近一条用户消息，LOW 分支的输入 token 大幅下降
+        system_prompt = LAYER1_UPDATE_SYSTEM_PROMPT
+        user_prompt = f"""
+
+客户资料：{profile_json(customer_profile)}
+最近一条用户消息：{latest_user_msg}
+
+Layer 3 评估与建议（包含收敛性分析，已覆盖完整对话要点）：
 {layer3_advice}
 
 请根据 Layer 3 的建议方向，特别关注：
@@ -469,7 +861,69 @@ Step1-7: （参考初始策略格式，但根据已收集/未收集信息调整
 
 ⚠️ 重点：根据 Layer 3 的【信息收敛进度】，在策略中明确指出"下一步优先追问哪个未确认的信息"。
         """
-        return call_llm(user_prompt, system_prompt)
+        return call_llm(user_prompt, system_prompt, stream=True,
+                        max_tokens=int(self.config.get("max_tokens_layer1_update", 500)))
+
+LAYER2_INSTRUCTIONS = """# INSTRUCTIONS
+You are a professional Collection Agent - focused on **execution**, not analysis.
+
+**YOUR ROLE**:
+- Execute "TODAY'S STRATEGY" from Layer 1 (策略层)
+- Layer 1's strategy includes "多步收敛路径" - follow the steps systematically
+- Check "CLIENT CURRENT STATE" to see what information is already collected
+- Focus on collecting the next piece of missing information according to the strategy
+
+**EXECUTION PRINCIPLES**:
+- Follow "TODAY'S STRATEGY" and its "多步收敛路径" (Step1-5)
+- Use "CLIENT CURRENT STATE" to know what's collected (✅) vs. missing (⏳)
+- Ask for ONE missing information at a time
+- Be natural - don't sound like a robot reading a script
+- If strategy says "Step2: 确认还款时间" and time is missing (⏳), ask about time
+
+**DPD RULE**:
+- If the client is past due (DPD≥0), enforce same-day closure: secure either full payment, or partial payment plus a specific time TODAY, or a same-day extension if eligible.
+
+**TONE ADJUSTMENT**:
+- If intent=1 (client willing to pay today): be helpful, supportive, collaborative
+- If intent=0 (client unwilling): increase pressure, use warnings, be firm
+- If payment_refusals is high: escalate pressure, mention consequences
+
+**REQUIRED OUTPUT (JSON FORMAT)**:
+You MUST respond with VALID JSON containing these exact fields, with "response" as the FIRST key:
+{
+  "response": "Final Chinese message - be natural, professional, vary sentence structure",
+  "user_analysis": "Brief analysis of client's current attitude",
+  "strategy_check": "Quote the specific strategy sentence or step that applies here",
+  "tactical_plan": "Which missing info to collect based on strategy's 多步收敛路径"
+}
+
+IMPORTANT: Output ONLY valid JSON, keys in the order shown above. No markdown code blocks, no explanation text before or after JSON."""
+
+# 严格结构化输出：服务端按 schema 约束解码，客户端解析不再可能失败；
+# response 放在首位与流式提取（先出用户可见文本）保持一致。
+# 相比 tool_choice 函数调用，json_schema 仍走 content 流，流式提取器无需改动。
+LAYER2_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "layer2_reply",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "response": {"type": "string"},
+                "user_analysis": {"type": "string"},
+                "strategy_check": {"type": "string"},
+                "tactical_plan": {"type": "string"},
+            },
+            "required": ["response", "user_analysis", "strategy_check", "tactical_plan"],
+            "additionalProperties": False,
+        },
+    },
+}
+
+# 端点（尤其是兼容代理）不支持 json_schema 时记一次、全程退回 json_object
+_LAYER2_SCHEMA_SUPPORTED = True
+
 
 class Layer2Executor:
     def __init__(self, config):
@@ -481,25 +935,37 @@ class Layer2Executor:
 保持专业态度，根据策略指导灵活调整沟通方式。
 遵守所有法律和道德规范。"""
 
-    def execute(self, strategy, chat_history, user_input, history_logs="", memory_context=""):
-        # Clean up the base prompt
-        cleaned_base_prompt = self.config.get('system_prompt', 'You are a helpful collection agent.')
-        if "You must output a JSON object" in cleaned_base_prompt:
-            cleaned_base_prompt = cleaned_base_prompt.replace("You must output a JSON object", "")
-        if "Output Format" in cleaned_base_prompt:
-            cleaned_base_prompt = cleaned_base_prompt.replace("Output Format", "")
-        
-        # 限制历史消息长度，避免上下文过长导致失败
-        max_history = self.config.get('max_history_messages', 10)
-        trimmed_history = chat_history[-max_history:] if isinstance(chat_history, list) else []
+        # Clean up the base prompt（只做一次）：单趟 sub 替代逐个 in + replace 扫描
+        cleaned_base_prompt = _PROMPT_NOISE_PAT.sub(
+            "", self.config.get('system_prompt', 'You are a helpful collection agent.'))
 
-        # 过滤配置，避免在系统提示中重复嵌入体积巨大的 system_prompt
+        # 过滤配置：system_prompt 已在前面嵌入，元数据与运行期调优旋钮
+        # （token 上限、窗口大小、超时等）对模型毫无意义，只嵌入业务规则键；
+        # sort_keys 保证序列化逐字节稳定，前缀才能被 OpenAI 自动缓存命中
         try:
-            filtered_config = {k: v for k, v in self.config.items() if k != 'system_prompt'}
-            filtered_config_text = json.dumps(filtered_config, ensure_ascii=False, indent=2)
+            filtered_config = {k: v for k, v in self.config.items()
+                               if k not in _CONFIG_PROMPT_EXCLUDE
+                               and not k.startswith(("max_tokens_", "max_len_"))}
+            # 紧凑序列化：indent=2 的美化空白纯粹烧 token，模型不需要
+            filtered_config_text = json.dumps(filtered_config, ensure_ascii=False, sort_keys=True,
+                                              separators=(",", ":"))
         except Exception:
             filtered_config_text = "{}"
 
+        # 静态前缀：基础提示 + 配置规则 + 指令块。每轮逐字节相同，
+        # 让 OpenAI 自动 prompt caching（≥1024 token 稳定前缀）在第二轮起生效。
+        self._static_prefix = f"""{cleaned_base_prompt}
+
+# CONFIG RULES (Reference)
+{filtered_config_text}
+
+{LAYER2_INSTRUCTIONS}"""
+
+    def _build_messages(self, strategy, chat_history, user_input, history_logs="", memory_context=""):
+        # 限制历史消息长度，避免上下文过长导致失败
+        max_history = self.config.get('max_history_messages', 10)
+        trimmed_history = chat_history[-max_history:] if isinstance(chat_history, list) else []
+
         # 预裁剪上下文块，进一步降低长度
         try:
             max_len_history_logs = int(self.config.get('max_len_history_logs', 1500))
@@ -514,130 +980,146 @@ class Layer2Executor:
         memory_context_short = (memory_context or "")[:max_len_memory_context]
         strategy_short = (strategy or "")[:max_len_strategy]
 
-        combined_system_prompt = f"""{cleaned_base_prompt}
+        # 按易变程度排序，尽量延长可被前缀缓存命中的稳定段：
+        # 静态前缀 → 会话内不变的历史日志 → 策略（仅 LOW 时更新）→ 每轮都变的记忆
+        stable_context = f"""# HISTORY (Last Interaction)
+{history_logs_short}"""
 
-# KEY CONTEXT (Read Carefully)
-1. **HISTORY (Last Interaction)**:
-{history_logs_short}
-
-2. **CLIENT CURRENT STATE (Memory)**:
-{memory_context_short}
-
-3. **TODAY'S STRATEGY (Your Supreme Command)**:
+        dynamic_context = f"""# KEY CONTEXT (Read Carefully)
+1. **TODAY'S STRATEGY (Your Supreme Command)**:
 {strategy_short}
 
-4. **CONFIG RULES (Reference)**:
-{filtered_config_text}
-
-# INSTRUCTIONS
-You are a professional Collection Agent - focused on **execution**, not analysis.
-
-**YOUR ROLE**: 
-- Execute "TODAY'S STRATEGY" from Layer 1 (策略层)
-- Layer 1's strategy includes "多步收敛路径" - follow the steps systematically
-- Check "CLIENT CURRENT STATE" to see what information is already collected
-- Focus on collecting the next piece of missing information according to the strategy
-
-**EXECUTION PRINCIPLES**:
-- Follow "TODAY'S STRATEGY" and its "多步收敛路径" (Step1-5)
-- Use "CLIENT CURRENT STATE" to know what's collected (✅) vs. missing (⏳)
-- Ask for ONE missing information at a time
-- Be natural - don't sound like a robot reading a script
-- If strategy says "Step2: 确认还款时间" and time is missing (⏳), ask about time
-
-**DPD RULE**:
-- If the client is past due (DPD≥0), enforce same-day closure: secure either full payment, or partial payment plus a specific time TODAY, or a same-day extension if eligible.
-
-**TONE ADJUSTMENT**:
-- If intent=1 (client willing to pay today): be helpful, supportive, collaborative
-- If intent=0 (client unwilling): increase pressure, use warnings, be firm
-- If payment_refusals is high: escalate pressure, mention consequences
-
-**REQUIRED OUTPUT (JSON FORMAT)**:
-You MUST respond with VALID JSON containing these exact fields:
-{{
-  "user_analysis": "Brief analysis of client's current attitude",
-  "strategy_check": "Quote the specific strategy sentence or step that applies here",
-  "tactical_plan": "Which missing info to collect based on strategy's 多步收敛路径",
-  "response": "Final Chinese message - be natural, professional, vary sentence structure"
-}}
-
-IMPORTANT: Output ONLY valid JSON. No markdown code blocks, no explanation text before or after JSON."""
-        
-        messages = [{"role": "system", "content": combined_system_prompt}]
-        for msg in trimmed_history:
-            messages.append({"role": msg['role'], "content": msg['content']})
-        messages.append({"role": "user", "content": user_input})
-        
+2. **CLIENT CURRENT STATE (Memory)**:
+{memory_context_short}"""
+
+        # 会话消息本身只含 role/content，无需逐条重建 dict，直接拼接
+        return [
+            {"role": "system", "content": self._static_prefix},
+            {"role": "system", "content": stable_context},
+            {"role": "system", "content": dynamic_context},
+            *trimmed_history,
+            {"role": "user", "content": user_input},
+        ]
+
+    def execute_stream(self, strategy, chat_history, user_input, history_logs="", memory_context="", result=None):
+        """
+        流式执行：发起 stream=True 请求，增量解析 JSON 中的 response 字段并逐字符产出，
+        可直接喂给 st.write_stream。流结束后完整回复与思考字段写入出参 result
+        （{"response": ..., "thought": ...}）；实例经 st.cache_resource 跨会话共享，
+        结果不能挂在 self 上，否则并发会话会互相覆盖。
+        """
+        if result is None:
+            result = {}
+        result["response"] = ""
+        result["thought"] = ""
+        messages = self._build_messages(strategy, chat_history, user_input, history_logs, memory_context)
+        content = ""
         try:
             # 调用前粗略估算 tokens（约 4 字符 ≈ 1 token）
-            def _approx_tokens(s: str) -> int:
-                try:
-                    return max(1, len(s) // 4)
-                except Exception:
-                    return 1
-
-            approx_total = _approx_tokens(combined_system_prompt) + sum(_approx_tokens(m.get('content', '')) for m in trimmed_history) + _approx_tokens(user_input)
+            approx_total = sum(max(1, len(m.get('content', '')) // 4) for m in messages)
             log(f"Layer2 preflight approx tokens: ~{approx_total}")
 
             request_timeout = self.config.get('request_timeout_seconds', 40)
-            log("Layer 2: Sending request to OpenAI with JSON format...")
-            response = client.chat.completions.create(
+            log("Layer 2: Sending streaming request to OpenAI with JSON format...")
+            # 输出 token 上限：解码耗时与生成 token 数线性相关，聊天回复不需要模型默认上限
+            max_tokens = int(self.config.get("max_tokens_layer2", 350))
+            global _LAYER2_SCHEMA_SUPPORTED
+            request_kwargs = dict(
                 model=MODEL_NAME,
                 messages=messages,
                 temperature=0.7,
-                response_format={"type": "json_object"},
-                timeout=request_timeout
+                timeout=request_timeout,
+                max_tokens=max_tokens,
+                stream=True
             )
-            log("Layer 2: Response received.")
-            # 记录 tokens 使用情况（如可用）
-            try:
-                usage = getattr(response, "usage", None)
-                if usage:
-                    prompt_tokens = getattr(usage, "prompt_tokens", getattr(usage, "input_tokens", None))
-                    completion_tokens = getattr(usage, "completion_tokens", getattr(usage, "output_tokens", None))
-                    total_tokens = getattr(usage, "total_tokens", None)
-                    log(f"Layer2 tokens - prompt:{prompt_tokens}, completion:{completion_tokens}, total:{total_tokens}")
-            except Exception as _:
-                pass
-            content = response.choices[0].message.content.strip()
-
-            # Parse JSON（带容错）
+            # 客户端建连时关掉了 SDK 重试（max_retries=0），这条不走 call_llm 的
+            # 直连流式路径要自带退避重试，否则瞬时网络错误会直接变成失败回复
+            retries = 2
+            for attempt in range(retries + 1):
+                try:
+                    get_rate_limiter().acquire(approx_total)
+                    try:
+                        stream = client.chat.completions.create(
+                            response_format=LAYER2_RESPONSE_FORMAT if _LAYER2_SCHEMA_SUPPORTED
+                            else {"type": "json_object"},
+                            **request_kwargs
+                        )
+                    except Exception as e:
+                        if _LAYER2_SCHEMA_SUPPORTED and ("response_format" in str(e) or "json_schema" in str(e)):
+                            log(f"json_schema response_format unsupported, falling back to json_object: {e}")
+                            _LAYER2_SCHEMA_SUPPORTED = False
+                            stream = client.chat.completions.create(
+                                response_format={"type": "json_object"}, **request_kwargs)
+                        else:
+                            raise
+                    break
+                except Exception as e:
+                    if attempt >= retries:
+                        raise
+                    log(f"Layer 2 stream request failed (attempt {attempt + 1}): {e}")
+                    time.sleep(1.5 ** attempt)
+
+            def _deltas():
+                for chunk in stream:
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        yield chunk.choices[0].delta.content
+
+            sink = []
+            produced = []
+            for piece in iter_json_string_field(_deltas(), "response", sink=sink):
+                produced.append(piece)
+                yield piece
+            log("Layer 2: Stream finished.")
+            content = (sink[0] if sink else "").strip()
+            streamed_response = "".join(produced)
+
+            # 流结束后解析完整 JSON，拿到思考字段（带容错）
             try:
-                data = json.loads(content)
-            except json.JSONDecodeError:
-                # 尝试提取第一个 JSON 对象
-                match = re.search(r"\{[\s\S]*\}", content)
+                data = json_loads(content)
+            except ValueError:
+                match = _JSON_OBJ_PAT.search(content)
+                data = None
                 if match:
                     try:
-                        data = json.loads(match.group(0))
-                    except Exception as e:
-                        raise e
-                else:
-                    raise
-            
-            # Combine thoughts for UI display
-            full_thought = (
-                f"**User Analysis**: {data.get('user_analysis', 'N/A')}\n\n"
-                f"**Strategy Check**: {data.get('strategy_check', 'N/A')}\n\n"
-                f"**Tactical Plan**: {data.get('tactical_plan', 'N/A')}"
-            )
-            
-            return data.get('response', ''), full_thought
-        except json.JSONDecodeError as e:
-            log(f"Layer 2 JSON Parse Error: {e}")
-            log(f"Raw response: {content}")
-            # 作为降级：直接返回原始文本作为回复，避免整个流程中断
-            return content, ""
+                        data = json_loads(match.group(0))
+                    except Exception:
+                        data = None
+
+            if data is not None:
+                result["thought"] = (
+                    f"**User Analysis**: {data.get('user_analysis', 'N/A')}\n\n"
+                    f"**Strategy Check**: {data.get('strategy_check', 'N/A')}\n\n"
+                    f"**Tactical Plan**: {data.get('tactical_plan', 'N/A')}"
+                )
+                result["response"] = data.get('response', streamed_response)
+                # 增量提取器没产出（如字段名被模型改写）但整体 JSON 有效时，
+                # 一次性补发解析出的回复，保证 st.write_stream 的气泡不空
+                if not streamed_response and result["response"]:
+                    yield result["response"]
+            else:
+                log("Layer 2 JSON Parse Error on streamed content.")
+                log(f"Raw response: {content}")
+                # 作为降级：直接返回原始文本作为回复，避免整个流程中断
+                result["response"] = streamed_response or content
+                if not streamed_response and content:
+                    yield content
         except Exception as e:
             log(f"Layer 2 Error: {e}")
             import traceback
             log(traceback.format_exc())
-            return f"System Error: {str(e)[:200]}", ""
+            result["response"] = f"System Error: {str(e)[:200]}"
+            yield result["response"]
 
-class Layer3Evaluator:
-    def evaluate(self, chat_history, history_logs, customer_profile, current_strategy, memory_context=""):
-        system_prompt = """
+    def execute(self, strategy, chat_history, user_input, history_logs="", memory_context=""):
+        """阻塞式执行：内部消费 execute_stream，保持原有 (response, thought) 返回值。"""
+        result = {}
+        for _ in self.execute_stream(strategy, chat_history, user_input, history_logs, memory_context, result=result):
+            pass
+        return result.get("response", ""), result.get("thought", "")
+
+# dedent 一次性去掉三引号字符串从 Python 缩进带进来的每行前导空格：
+# 这些空白每轮都作为输入 token 计费，对模型毫无信息量
+LAYER3_SYSTEM_PROMPT = textwrap.dedent("""
         你是催收策略的评估专家和信息收敛分析师。
         你的任务有三个：
         1. 评估当前策略在客户身上的有效性，特别是"客户回款的可能性"
@@ -652,42 +1134,93 @@ class Layer3Evaluator:
         5. 客户记忆状态（Memory）- 包含已收集和未收集的信息
 
         【关键信息收敛分析】
-        检查以下 5 个关键信息的收集状态：
+        检查以下 5 个关键信息的收集状态（后续只引用编号即可）：
         1. 还款能力 (has_ability_confirmed) - 客户是否有钱还
         2. 还款时间 (payment_date_confirmed) - 具体哪天还
         3. 还款金额 (payment_amount_confirmed) - 能还多少
         4. 付款方式 (payment_type_confirmed) - 全额还是部分
         5. 展期请求 (extension_requested) - 是否请求展期
-        
-        根据 Memory 状态，分析：
-        - 哪些信息已经收集到（✅）
-        - 哪些信息还缺失（⏳）
-        - 信息收集的优先级顺序
-        - 当前策略是否有效推进信息收集
-        
+
         【重要】你的建议是给 Layer 1（策略层）的，不是给 Layer 2（执行层）的。
         - 如果收敛进度慢，建议 Layer 1 调整策略（比如增加压力、改变话术）
         - 如果回款可能性低，建议 Layer 1 重新制定策略框架
-        
-        请按以下格式输出：
-        【分析】简要分析客户的抗拒点或困难，以及当前策略的有效性。
-        【回款可能性】HIGH / MEDIUM / LOW
-        【信息收敛进度】已收集：[列出已确认的信息，如"能力(有钱)、时间(2025-12-30)"] / 未收集：[列出缺失的信息]
-        【收敛效率评估】(评价当前策略是否有效推进信息收集，如"收敛速度慢，3轮对话仅收集到1个信息")
-        【给 Layer 1 的建议】(如果可能性为LOW 或 收敛效率低，建议调整策略方向；比如"建议在策略中增加明确的时间追问环节")
-        """
+
+        输出严格 JSON，不要任何其他文字，字段如下：
+        {"probability": "HIGH" | "MEDIUM" | "LOW",
+         "analysis": "简要分析客户的抗拒点或困难，以及当前策略的有效性",
+         "collected_ids": [已收集到的关键信息编号],
+         "missing_ids": [仍缺失的关键信息编号],
+         "advice": "给 Layer 1 的策略调整建议（可能性为 LOW 或收敛低效时必填）"}
+        """).strip()
+
+# 与上方 5 项关键信息一一对应：模型只输出编号，人类可读文案在客户端渲染，
+# 省掉每轮重复生成的收敛描述 token
+CONVERGENCE_ITEMS = {
+    1: "还款能力",
+    2: "还款时间",
+    3: "还款金额",
+    4: "付款方式",
+    5: "展期请求",
+}
+
+
+def _render_convergence(data):
+    """把 Layer 3 输出的编号转回文字；兼容旧的 convergence 纯文本字段。"""
+    collected = data.get("collected_ids") or []
+    missing = data.get("missing_ids") or []
+    if not collected and not missing:
+        return data.get("convergence", "")
+    def names(ids):
+        return "、".join(CONVERGENCE_ITEMS[i] for i in ids
+                         if isinstance(i, int) and i in CONVERGENCE_ITEMS) or "无"
+    return f"已收集：{names(collected)} / 未收集：{names(missing)}"
+
+
+class Layer3Evaluator:
+    def evaluate(self, chat_history_json, history_logs, customer_profile, current_strategy, memory_context=""):
+        system_prompt = LAYER3_SYSTEM_PROMPT
         user_prompt = f"""
 客户记忆状态（Memory）：
 {memory_context}
 
-今日完整对话历史：{json.dumps(chat_history, ensure_ascii=False, indent=2)}
+今日对话历史（近期窗口）：{chat_history_json}
 
-客户资料：{json.dumps(customer_profile, ensure_ascii=False)}
+客户资料：{profile_json(customer_profile)}
 
 当前策略：
 {current_strategy}
 """
-        return call_llm(user_prompt, system_prompt)
+        # 评估是纯函数：temperature=0 使判定确定化，配合精确匹配缓存可消除重跑的重复调用；
+        # JSON 模式 + max_tokens 上限把生成 token 从整段 markdown 压到一个结构化判定
+        result = call_llm(user_prompt, system_prompt, json_mode=True, temperature=0.0,
+                          use_cache=True, max_tokens=300)
+        try:
+            data = json_loads(result)
+        except (ValueError, TypeError):
+            # 容错：退回原始文本，主流程仍按【回款可能性】子串判定
+            return result
+        return (
+            f"【分析】{data.get('analysis', '')}\n"
+            f"【回款可能性】{data.get('probability', 'MEDIUM')}\n"
+            f"【信息收敛进度】{_render_convergence(data)}\n"
+            f"【给 Layer 1 的建议】{data.get('advice', '')}"
+        )
+
+@st.cache_resource(show_spinner=False)
+def get_layers(config_key, history_logs, _config):
+    """按配置指纹 + 历史记录缓存三层实例，避免每轮重建。
+
+    Layer2 的静态前缀拼接（清洗 system_prompt + 过滤配置序列化）与 Layer1 的
+    历史预序列化都只在构造时做一次。缓存按进程共享、可能同时服务多个会话，
+    因此实例方法不得把单次调用的结果写到 self 上（流式结果经 result 出参返回）。
+    _config 带下划线前缀跳过 Streamlit 哈希，内容变化由 config_key 承担。
+    """
+    return (
+        Layer1StrategyManager(_config, [history_logs]),
+        Layer2Executor(_config),
+        Layer3Evaluator(),
+    )
+
 
 # --- Main App Logic ---
 
@@ -696,11 +1229,13 @@ def main():
     st.sidebar.title("⚙️ Configuration")
     
     # Config File Selection
-    config_files = [f for f in os.listdir("configs") if f.endswith(".yaml")]
+    config_files = list_config_files()
     selected_config = st.sidebar.selectbox("Select Config", config_files, index=config_files.index("T0.yaml") if "T0.yaml" in config_files else 0)
     
     if selected_config:
-        config = load_config(os.path.join("configs", selected_config))
+        config_path = os.path.join("configs", selected_config)
+        config_mtime = os.path.getmtime(config_path)
+        config = load_config(config_path, config_mtime)
     else:
         st.error("No config file found!")
         return
@@ -721,7 +1256,7 @@ def main():
     }
     profile_str = st.sidebar.text_area("Edit Profile (JSON)", json.dumps(default_profile, indent=2, ensure_ascii=False), height=250)
     try:
-        customer_profile = json.loads(profile_str)
+        customer_profile = parse_profile(profile_str)
     except:
         st.sidebar.error("Invalid JSON in Profile")
         customer_profile = default_profile
@@ -770,23 +1305,59 @@ def main():
     # Initialize Session State
     if "messages" not in st.session_state:
         st.session_state.messages = []
+    # 消息本体只存 role/content（直接可喂给模型，序列化无冗余键）；
+    # thought / Layer 3 评估 / Layer 1 更新等分析面板数据按消息下标另存一份
+    if "analyses" not in st.session_state:
+        st.session_state.analyses = {}
+    if "msg_frags" not in st.session_state:
+        st.session_state.msg_frags = []
     if "strategy" not in st.session_state:
         st.session_state.strategy = None
     if "layer1_analysis" not in st.session_state:
         st.session_state.layer1_analysis = None
+    memory_path = memory_persist_path(config, customer_profile)
     if "memory" not in st.session_state:
         st.session_state.memory = MemoryLayer(llm_caller=call_llm)
-    
+        if memory_path and os.path.exists(memory_path):
+            # 回头客：直接恢复上次会话的记忆，跳过一次 LLM 历史解析
+            st.session_state.memory.load(memory_path)
+
+    # 预热 Layer 1：首轮策略只依赖侧边栏的画像+历史，页面一渲染就推测性地在后台生成，
+    # 与下面的历史解析并行。侧边栏输入变化（text_area 失焦提交）会用新输入重新预热。
+    if st.session_state.strategy is None:
+        prewarm_key = (profile_str, history_logs, selected_config)
+        if st.session_state.get("strategy_future_key") != prewarm_key:
+            prewarm_layer1, _, _ = get_layers((selected_config, config_mtime), history_logs, config)
+            st.session_state.strategy_future = get_executor().submit(
+                prewarm_layer1.generate_initial_strategy_with_opening,
+                customer_profile, build_opening_instruction(customer_profile))
+            st.session_state.strategy_future_key = prewarm_key
+
     # 解析历史记录（仅在首次初始化时执行一次）
     if "history_parsed" not in st.session_state:
-        with st.spinner("🔍 Analyzing history logs..."):
-            st.session_state.memory.parse_history_summary(history_logs)
+        if st.session_state.memory.memory.get("history_summary"):
+            # 磁盘恢复的记忆已带历史分析，省掉这次解析调用
+            log("History summary restored from persisted memory, skipping parse")
+        else:
+            with st.spinner("🔍 Analyzing history logs..."):
+                st.session_state.memory.parse_history_summary(history_logs)
         st.session_state.history_parsed = True
 
     # Reset Button
     if st.sidebar.button("Reset Session"):
         st.session_state.messages = []
+        st.session_state.analyses = {}
+        st.session_state.msg_frags = []
         st.session_state.strategy = None
+        # 清掉预热键，让下一次重跑重新在后台发起策略生成（相同输入命中 LLM 缓存）
+        st.session_state.pop("strategy_future", None)
+        st.session_state.pop("strategy_future_key", None)
+        # 滚动摘要属于被清掉的那段对话，留着会把旧会话内容注入新会话的上下文
+        st.session_state.pop("rolling_summary", None)
+        st.session_state.pop("rolling_summary_len", None)
+        # 旧会话挂起的 Layer 3 评估同理：迟到的判定会挂错消息索引、用陈旧上下文改策略
+        st.session_state.pop("pending_eval_future", None)
+        st.session_state.pop("pending_eval_idx", None)
         st.session_state.layer1_analysis = None
         st.session_state.memory = MemoryLayer(llm_caller=call_llm)
         st.session_state.history_parsed = False
@@ -795,257 +1366,400 @@ def main():
         # --- Main Area ---
     st.title("🤖 Collection Agent (Easy Mode)")
 
-    # Layout: 2 Columns
-    # Col 1: Chat (60%)
-    # Col 2: Strategy & Analysis (40%)
-    col_chat, col_info = st.columns([2, 1.2])
+    # 聊天区包成 st.fragment：聊天输入只重跑本片段，侧边栏文本框的逐键 rerun
+    # 不再重绘整页；旧版 Streamlit 没有 fragment 时退化为普通函数调用（整页重跑）
+    _fragment = getattr(st, "fragment", None)
 
-    # --- Right Column: Strategy & Analysis ---
-    with col_info:
-        st.subheader("🧠 Agent Brain (Strategy & Analysis)")
+    def chat_area():
+        # Layout: 2 Columns
+        # Col 1: Chat (60%)
+        # Col 2: Strategy & Analysis (40%)
+        col_chat, col_info = st.columns([2, 1.2])
+
+        # --- Right Column: Strategy & Analysis ---
+        with col_info:
+            st.subheader("🧠 Agent Brain (Strategy & Analysis)")
         
-        # NEW: 显示当前记忆状态
-        with st.expander("👤 Client Memory (Current)", expanded=True):
-            memory_dict = st.session_state.memory.to_dict()
+            # NEW: 显示当前记忆状态
+            with st.expander("👤 Client Memory (Current)", expanded=True):
+                memory_dict = st.session_state.memory.to_dict()
             
-            # 核心指标：意图
-            intent_emoji = "✅ 有意愿还" if memory_dict.get('intent_to_pay_today') == 1 else "❌ 无意愿还"
-            st.write(f"**今日意图**: {intent_emoji}")
+                # 核心指标：意图
+                intent_emoji = "✅ 有意愿还" if memory_dict.get('intent_to_pay_today') == 1 else "❌ 无意愿还"
+                st.write(f"**今日意图**: {intent_emoji}")
             
-            # 行为指标
-            st.write(f"**拒付次数**: {memory_dict.get('payment_refusals', 0)} 次")
-            st.write(f"**失约次数**: {memory_dict.get('broken_promises', 0)} 次")
+                # 行为指标
+                st.write(f"**拒付次数**: {memory_dict.get('payment_refusals', 0)} 次")
+                st.write(f"**失约次数**: {memory_dict.get('broken_promises', 0)} 次")
             
-            # 能力和原因
-            st.write(f"**能力评估**: {memory_dict.get('ability_score', '未知')}")
-            st.write(f"**原因分类**: {memory_dict.get('reason_category', '未知')}")
+                # 能力和原因
+                st.write(f"**能力评估**: {memory_dict.get('ability_score', '未知')}")
+                st.write(f"**原因分类**: {memory_dict.get('reason_category', '未知')}")
             
-            # 障碍
-            if memory_dict.get('unresolved_obstacles'):
-                st.write(f"**待解决**: {', '.join(memory_dict['unresolved_obstacles'])}")
+                # 障碍
+                if memory_dict.get('unresolved_obstacles'):
+                    st.write(f"**待解决**: {', '.join(memory_dict['unresolved_obstacles'])}")
             
-            # ======== 拒绝历史展示 ========
-            refusal_hist = memory_dict.get('refusal_history', [])
-            if refusal_hist:
-                st.divider()
-                st.markdown("**🚫 拒绝还款历史**")
+                # ======== 拒绝历史展示 ========
+                refusal_hist = memory_dict.get('refusal_history', [])
+                if refusal_hist:
+                    st.divider()
+                    st.markdown("**🚫 拒绝还款历史**")
                 
-                # 拒绝类型标签颜色映射
-                type_labels = {
-                    "no_ability": "💰 无能力",
-                    "refuse": "✋ 明确拒绝",
-                    "delay": "⏰ 延迟/拖延"
-                }
+                    # 拒绝类型标签颜色映射
+                    type_labels = {
+                        "no_ability": "💰 无能力",
+                        "refuse": "✋ 明确拒绝",
+                        "delay": "⏰ 延迟/拖延"
+                    }
                 
-                # 按时间逆序显示（最新的在前）
-                for entry in reversed(refusal_hist):
-                    refusal_type = entry.get("type", "delay")
-                    timestamp = entry.get("timestamp", "")
-                    reason = entry.get("reason", "")
+                    # 按时间逆序显示（最新的在前）
+                    for entry in reversed(refusal_hist):
+                        refusal_type = entry.get("type", "delay")
+                        timestamp = entry.get("timestamp", "")
+                        reason = entry.get("reason", "")
                     
-                    type_label = type_labels.get(refusal_type, "未知")
-                    st.caption(f"**{timestamp}** | {type_label}\n{reason}")
+                        type_label = type_labels.get(refusal_type, "未知")
+                        st.caption(f"**{timestamp}** | {type_label}\n{reason}")
             
-            # ======== 新增：收敛性进度显示 ========
-            st.divider()
-            st.markdown("**🎯 关键信息收敛进度**")
+                # ======== 新增：收敛性进度显示 ========
+                st.divider()
+                st.markdown("**🎯 关键信息收敛进度**")
             
-            conv_col1, conv_col2 = st.columns(2)
-            with conv_col1:
-                ability_icon = "✅" if memory_dict.get('has_ability_confirmed') else "⏳"
-                st.write(f"{ability_icon} **还款能力**: {memory_dict.get('ability_score', '未确认')}")
+                conv_col1, conv_col2 = st.columns(2)
+                with conv_col1:
+                    ability_icon = "✅" if memory_dict.get('has_ability_confirmed') else "⏳"
+                    st.write(f"{ability_icon} **还款能力**: {memory_dict.get('ability_score', '未确认')}")
                 
-                date_icon = "✅" if memory_dict.get('payment_date_confirmed') else "⏳"
-                st.write(f"{date_icon} **还款时间**: {memory_dict.get('payment_date_confirmed') or '未确认'}")
+                    date_icon = "✅" if memory_dict.get('payment_date_confirmed') else "⏳"
+                    st.write(f"{date_icon} **还款时间**: {memory_dict.get('payment_date_confirmed') or '未确认'}")
                 
-                extension_icon = "⚠️" if memory_dict.get('extension_requested') else "✅"
-                st.write(f"{extension_icon} **展期请求**: {'是' if memory_dict.get('extension_requested') else '否'}")
+                    extension_icon = "⚠️" if memory_dict.get('extension_requested') else "✅"
+                    st.write(f"{extension_icon} **展期请求**: {'是' if memory_dict.get('extension_requested') else '否'}")
             
-            with conv_col2:
-                amount_icon = "✅" if memory_dict.get('payment_amount_confirmed') else "⏳"
-                st.write(f"{amount_icon} **还款金额**: {memory_dict.get('payment_amount_confirmed') or '未确认'}")
+                with conv_col2:
+                    amount_icon = "✅" if memory_dict.get('payment_amount_confirmed') else "⏳"
+                    st.write(f"{amount_icon} **还款金额**: {memory_dict.get('payment_amount_confirmed') or '未确认'}")
                 
-                type_icon = "✅" if memory_dict.get('payment_type_confirmed') else "⏳"
-                payment_type_text = {"full": "全额", "partial": "部分", "": "未确认"}.get(memory_dict.get('payment_type_confirmed', ''), '未确认')
-                st.write(f"{type_icon} **付款方式**: {payment_type_text}")
+                    type_icon = "✅" if memory_dict.get('payment_type_confirmed') else "⏳"
+                    payment_type_text = {"full": "全额", "partial": "部分", "": "未确认"}.get(memory_dict.get('payment_type_confirmed', ''), '未确认')
+                    st.write(f"{type_icon} **付款方式**: {payment_type_text}")
             
-            # 历史分析结果
-            if memory_dict.get('history_summary'):
-                st.divider()
-                st.markdown("**📜 历史分析**")
-                st.caption(memory_dict.get('history_summary', '暂无'))
-                col1, col2 = st.columns(2)
-                with col1:
-                    st.metric("历史失约", f"{memory_dict.get('history_broken_promises', 0)} 次")
-                with col2:
-                    st.metric("历史能力", memory_dict.get('history_ability_score', '未知'))
+                # 历史分析结果
+                if memory_dict.get('history_summary'):
+                    st.divider()
+                    st.markdown("**📜 历史分析**")
+                    st.caption(memory_dict.get('history_summary', '暂无'))
+                    col1, col2 = st.columns(2)
+                    with col1:
+                        st.metric("历史失约", f"{memory_dict.get('history_broken_promises', 0)} 次")
+                    with col2:
+                        st.metric("历史能力", memory_dict.get('history_ability_score', '未知'))
         
-        st.divider()
-        
-        # 1. Global Strategy (Layer 1)
-        with st.expander("📋 Daily Strategy (Layer 1)", expanded=True):
-            if not st.session_state.strategy:
-                # Auto-initialize: Generate strategy and opening message immediately
-                with st.spinner("Layer 1 Manager is analyzing history and generating strategy..."):
-                    layer1 = Layer1StrategyManager(config, [history_logs])
-                    full_strategy_output = layer1.generate_initial_strategy(customer_profile)
-                    st.session_state.strategy = full_strategy_output
-                    
-                    # Generate opening message with memory context
-                    memory_context = st.session_state.memory.get_memory_context()
-                    layer2 = Layer2Executor(config)
-                    # Layer2 now receives memory_context for awareness of history
-                    # 根据 DPD 加强初始执行指令：DPD≥0 必须当天闭环
-                    opening_instruction = (
-                        "Start the conversation naturally. If there's history with the customer, acknowledge it and continue. If new customer, introduce yourself and explain your role."
-                    )
-                    if isinstance(customer_profile.get("DPD"), int) and customer_profile["DPD"] >= 0:
-                        opening_instruction += " Also, DPD≥0: ensure a same-day repayment closure (full payment, or partial + a specific time today, or, if eligible, same-day extension)."
-
-                    opening_response, thought = layer2.execute(
-                        full_strategy_output, 
-                        [], 
-                        opening_instruction,
-                        history_logs,
-                        memory_context  # NEW: Pass memory context so Layer2 knows the history
-                    )
-                    
-                    st.session_state.messages.append({"role": "assistant", "content": opening_response, "thought": thought})
-                    st.rerun()
-            else:
-                st.info(st.session_state.strategy)
-                
-                # Add a button to force regenerate strategy if needed
-                if st.button("Regenerate Strategy"):
-                    st.session_state.strategy = None
-                    st.session_state.messages = [] # Also clear messages to restart conversation
-                    st.rerun()
+            st.divider()
         
-        st.divider()
-        st.markdown("**Thinking Process Log**")
-
-    # --- Left Column: Chat Interface ---
-    with col_chat:
-        st.subheader("💬 Chat Interface")
-
-    # --- Render History ---
-    for i, msg in enumerate(st.session_state.messages):
-        # Chat Content (Col 1)
-        with col_chat:
-            with st.chat_message(msg["role"]):
-                st.write(msg["content"])
+            # 1. Global Strategy (Layer 1)
+            with st.expander("📋 Daily Strategy (Layer 1)", expanded=True):
+                if not st.session_state.strategy:
+                    # Auto-initialize: Generate strategy and opening message immediately
+                    with st.spinner("Layer 1 Manager is analyzing history and generating strategy..."):
+                        layer1, layer2, _ = get_layers((selected_config, config_mtime), history_logs, config)
+                        opening_instruction = build_opening_instruction(customer_profile)
+                        # 优先收割预热的后台结果（输入未变时通常立即返回）；
+                        # 首轮策略 + 开场白已合并为一次调用，省掉串行的 Layer 2 开场请求
+                        future = st.session_state.pop("strategy_future", None)
+                        full_strategy_output = None
+                        if future is not None and st.session_state.get("strategy_future_key") == (profile_str, history_logs, selected_config):
+                            try:
+                                full_strategy_output, opening_response = future.result()
+                            except Exception as e:
+                                # 预热失败（如瞬时网络错误）不应让整个会话崩溃，降级为同步重试
+                                log(f"Prewarmed strategy future failed, retrying inline: {e}")
+                                full_strategy_output = None
+                        if full_strategy_output is None:
+                            full_strategy_output, opening_response = layer1.generate_initial_strategy_with_opening(
+                                customer_profile, opening_instruction)
+                        st.session_state.strategy = full_strategy_output
+                        st.session_state.strategy_inputs_key = (profile_str, history_logs, selected_config)
+
+                        thought = ""
+                        if opening_response is None:
+                            # 合并调用解析失败时回退：由 Layer 2 带记忆上下文单独生成开场白
+                            memory_context = st.session_state.memory.get_memory_context()
+                            opening_response, thought = layer2.execute(
+                                full_strategy_output,
+                                [],
+                                opening_instruction,
+                                history_logs,
+                                memory_context
+                            )
+
+                        append_message("assistant", opening_response)
+                        if thought:
+                            st.session_state.analyses[len(st.session_state.messages) - 1] = {"thought": thought}
+                        # 不再 st.rerun()：直接落到下方的历史渲染循环把开场白画出来，
+                        # 避免冷启动时整个脚本（侧边栏、配置加载）立即重跑第二遍
+                        st.info(st.session_state.strategy)
+                else:
+                    st.info(st.session_state.strategy)
+                    if st.session_state.get("strategy_inputs_key") != (profile_str, history_logs, selected_config):
+                        # 策略按 session_state 守卫，不随侧边栏输入自动失效；输入变了只提示，
+                        # 由用户决定何时重新生成（相同输入的重新生成会命中 LLM 缓存，零成本）
+                        st.caption("⚠️ 画像/历史/配置已修改，当前策略基于旧输入，可点击下方按钮重新生成")
+
+                    # Add a button to force regenerate strategy if needed
+                    if st.button("Regenerate Strategy"):
+                        st.session_state.strategy = None
+                        st.session_state.messages = [] # Also clear messages to restart conversation
+                        st.session_state.analyses = {}
+                        st.session_state.msg_frags = []
+                        st.session_state.pop("strategy_future", None)
+                        st.session_state.pop("strategy_future_key", None)
+                        st.session_state.pop("rolling_summary", None)
+                        st.session_state.pop("rolling_summary_len", None)
+                        st.session_state.pop("pending_eval_future", None)
+                        st.session_state.pop("pending_eval_idx", None)
+                        st.rerun()
         
-        # Analysis Content (Col 2)
-        if msg["role"] == "assistant":
-            with col_info:
-                st.markdown(f"**Turn {i+1} Analysis**")
-                
-                # Layer 3
-                if "layer3_evaluation" in msg and msg["layer3_evaluation"]:
-                    with st.expander("🛡️ Layer 3 Evaluation", expanded=False):
-                        st.caption(msg["layer3_evaluation"])
-                
-                # Layer 1 Update Event
-                if "layer1_update" in msg and msg["layer1_update"]:
-                    st.warning(f"🔄 Strategy Updated at Turn {i+1}")
-                    with st.expander("View New Strategy"):
-                        st.caption(msg["layer1_update"])
-
-                # Layer 2 Thought
-                if "thought" in msg and msg["thought"]:
-                    with st.expander("💭 Layer 2 Thought", expanded=False):
-                        st.caption(msg["thought"])
-                
-                st.divider()
+            st.divider()
+            st.markdown("**Thinking Process Log**")
 
-    # --- User Input Handling ---
-    if prompt := st.chat_input("Type your reply here..."):
-        # 1. 追踪到记忆（核心改进：调用 LLM 做意图判断 0/1）
-        st.session_state.messages.append({"role": "user", "content": prompt})
-        
+        # --- Left Column: Chat Interface ---
         with col_chat:
-            with st.chat_message("user"):
-                st.write(prompt)
+            st.subheader("💬 Chat Interface")
+
+        # --- Render History ---
+        # 每次重跑都会整页重绘：气泡本身便宜，但 50 轮会话的 expander + markdown 思考块
+        # 是主要的 DOM 开销。只为最近 N 轮渲染分析面板，老轮次保留气泡即可。
+        analysis_window = int(config.get("analysis_render_window", 6))
+        analysis_cutoff = len(st.session_state.messages) - 2 * analysis_window
+        # 可选的气泡窗口：超长会话只画最近 N 轮，更早的折叠成一行提示。
+        # （"只渲染新增消息"的指针方案在 Streamlit 下不可行：每次重跑都会清空输出）
+        render_window = int(config.get("chat_render_window", 0))
+        start_idx = 0
+        if render_window > 0:
+            start_idx = max(0, len(st.session_state.messages) - 2 * render_window)
+            if start_idx:
+                with col_chat:
+                    st.caption(f"… 已折叠更早的 {start_idx} 条消息")
+        for i, msg in enumerate(st.session_state.messages[start_idx:], start=start_idx):
+            # Chat Content (Col 1)
+            with col_chat:
+                with st.chat_message(msg["role"]):
+                    st.write(msg["content"])
+
+            # Analysis Content (Col 2)
+            analysis = st.session_state.analyses.get(i)
+            if msg["role"] == "assistant" and analysis and i >= analysis_cutoff:
+                with col_info:
+                    st.markdown(f"**Turn {i+1} Analysis**")
+
+                    # Layer 3
+                    if analysis.get("layer3_evaluation"):
+                        with st.expander("🛡️ Layer 3 Evaluation", expanded=False):
+                            st.caption(analysis["layer3_evaluation"])
+
+                    # Layer 1 Update Event
+                    if analysis.get("layer1_update"):
+                        st.warning(f"🔄 Strategy Updated at Turn {i+1}")
+                        with st.expander("View New Strategy"):
+                            st.caption(analysis["layer1_update"])
+
+                    # Layer 2 Thought
+                    if analysis.get("thought"):
+                        with st.expander("💭 Layer 2 Thought", expanded=False):
+                            st.caption(analysis["thought"])
+
+                    st.divider()
+
+        # --- User Input Handling ---
+        if prompt := st.chat_input("Type your reply here..."):
+            # 1. 追踪到记忆（核心改进：调用 LLM 做意图判断 0/1）
+            append_message("user", prompt)
         
-        # 2. 初始化 Layers
-        layer1 = Layer1StrategyManager(config, [history_logs])
-        layer2 = Layer2Executor(config)
-        layer3 = Layer3Evaluator()
+            with col_chat:
+                with st.chat_message("user"):
+                    st.write(prompt)
         
-        # 3. 分析记忆（包含 LLM 意图判断）
-        with st.spinner("🧠 Analyzing user intent and building memory..."):
-            st.session_state.memory.extract_from_dialogue(prompt, st.session_state.messages)
-        
-        # 4. 生成记忆摘要
-        memory_context = st.session_state.memory.get_memory_context()
-        
-        # 5. Layer 3: Evaluation（新增：传入 memory_context）
-        with col_info:
-            st.markdown(f"**Current Turn Analysis**")
-            with st.spinner("🛡️ Layer 3 Evaluating..."):
-                evaluation_output = layer3.evaluate(
-                    st.session_state.messages,
+            # 2. 取会话级缓存的 Layers（配置/历史不变时直接复用）
+            layer1, layer2, layer3 = get_layers((selected_config, config_mtime), history_logs, config)
+
+            # 2b. 收割上一轮未就绪的 Layer 3 评估：评估只影响策略时效，
+            #     迟到的 LOW 判定在本轮开头（Layer 2 执行前）补做策略更新
+            pending_eval = st.session_state.pop("pending_eval_future", None)
+            if pending_eval is not None:
+                pending_idx = st.session_state.pop("pending_eval_idx", None)
+                late_eval = None
+                try:
+                    late_eval = pending_eval.result(timeout=0.1)
+                except FutureTimeoutError:
+                    log("Deferred Layer 3 evaluation still not ready; dropping it")
+                except Exception as e:
+                    log(f"Deferred Layer 3 evaluation failed: {e}")
+                if late_eval is not None:
+                    if pending_idx is not None:
+                        st.session_state.analyses.setdefault(pending_idx, {})["layer3_evaluation"] = late_eval
+                    if is_low_probability(late_eval):
+                        st.session_state.strategy = layer1.update_strategy(
+                            st.session_state.strategy, late_eval, prompt, customer_profile)
+
+            # 3. 记忆抽取丢进后台线程，与 Layer 3 评估、Layer 2 流式并行：
+            #    Layer 2 的提示里已带本轮用户原文，记忆字段晚一轮并入上下文可接受，
+            #    换取这次 LLM 抽取调用完全退出关键路径（流式结束后收割）
+            mem_future = get_executor().submit(
+                st.session_state.memory.extract_from_dialogue,
+                prompt, st.session_state.messages)
+
+            # 4. 生成记忆摘要（抽取尚未完成，取的是上一轮为止的记忆状态）
+            memory_context = st.session_state.memory.get_memory_context()
+
+            # 4b. 上下文裁剪：只带最近 k 轮原文，更早的对话压缩为滚动摘要
+            k = int(config.get("history_window_turns", 8))
+            summary_threshold = int(config.get("history_summary_threshold", 20))
+            if "rolling_summary" not in st.session_state:
+                st.session_state.rolling_summary = ""
+                st.session_state.rolling_summary_len = 0
+            old_part = st.session_state.messages[:-2 * k]
+            # 摊还：窗口外部分每多积累 4 条才重新摘要一次，而不是每滑出一条就重算
+            if (len(st.session_state.messages) > summary_threshold
+                    and len(old_part) >= st.session_state.rolling_summary_len + 4):
+                with st.spinner("📝 Summarizing older context..."):
+                    st.session_state.rolling_summary = layer1.summarize_old(old_part)
+                    st.session_state.rolling_summary_len = len(old_part)
+            if st.session_state.rolling_summary:
+                memory_context = (
+                    f"{memory_context}\n\n【早期对话摘要】（覆盖窗口外更早的 "
+                    f"{st.session_state.rolling_summary_len} 条消息）\n{st.session_state.rolling_summary}"
+                )
+            recent_messages = trim_history(st.session_state.messages, k)
+            # 片段在 append_message 时已序列化好，这里只做切片拼接
+            recent_window_json = "[" + ",".join(st.session_state.msg_frags[-2 * k:]) + "]"
+
+            # 5. Layer 3 评估与 Layer 2 执行并行：两次调用都是网络绑定且互相独立，
+            #    Layer 3 丢进后台线程，Layer 2 先用当前策略推测执行（流式渲染）。
+            triage_verdict = cheap_triage(prompt)
+            if triage_verdict is None:
+                eval_future = get_executor().submit(
+                    layer3.evaluate,
+                    recent_window_json,
                     [history_logs],
                     customer_profile,
                     st.session_state.strategy,
                     memory_context  # NEW：传入记忆上下文用于收敛分析
                 )
-            
-            with st.expander("🛡️ Layer 3 Evaluation", expanded=True):
-                st.caption(evaluation_output)
-        
-        # 6. 检查是否需要更新策略
-        is_low_prob = "LOW" in evaluation_output or "可能性】LOW" in evaluation_output
-        
-        layer1_update_text = None
-        if is_low_prob:
+            else:
+                eval_future = None
+                log(f"Layer 3 skipped via cheap triage: {triage_verdict}")
+
+            exec_result = {}
+            with col_chat:
+                with st.chat_message("assistant"):
+                    response_slot = st.empty()
+                    with response_slot.container():
+                        st.write_stream(layer2.execute_stream(
+                            st.session_state.strategy,
+                            recent_messages[:-1],
+                            prompt,
+                            history_logs,
+                            memory_context,  # NEW：传入记忆上下文
+                            result=exec_result
+                        ))
+            response = exec_result.get("response", "")
+            thought = exec_result.get("thought", "")
+
+            # 收割后台记忆抽取并持久化（通常已在 Layer 2 流式期间完成）
+            try:
+                mem_future.result()
+            except Exception as e:
+                log(f"Memory extraction failed: {e}")
+            if memory_path:
+                try:
+                    st.session_state.memory.save(memory_path)
+                except OSError as e:
+                    log(f"Memory persist failed: {e}")
+
+            # 收割 Layer 3 评估结果（通常在 Layer 2 流式期间已完成）
             with col_info:
-                with st.spinner("⚠️ Low probability! Updating Strategy..."):
-                    new_strategy = layer1.update_strategy(
-                        st.session_state.strategy, 
-                        prompt, 
-                        st.session_state.messages,
-                        customer_profile,
-                        evaluation_output
+                st.markdown(f"**Current Turn Analysis**")
+                if eval_future is None:
+                    evaluation_output = (
+                        f"【分析】规则分诊命中明确信号，本轮未调用 LLM 评估。\n"
+                        f"【回款可能性】{triage_verdict}"
                     )
-                    st.session_state.strategy = new_strategy
-                    layer1_update_text = new_strategy
-                    st.warning("🔄 Strategy Updated!")
-                    with st.expander("View New Strategy"):
-                        st.caption(new_strategy)
-        
-        # 7. Layer 2: Execution（关键改进：传入记忆上下文）
-        with col_info:
-            with st.spinner("💭 Layer 2 Thinking..."):
-                response, thought = layer2.execute(
-                    st.session_state.strategy, 
-                    st.session_state.messages[:-1], 
-                    prompt,
-                    history_logs,
-                    memory_context  # NEW：传入记忆上下文
-                )
+                else:
+                    with st.spinner("🛡️ Layer 3 Evaluating..."):
+                        # Layer 2 流式输出已覆盖大部分评估耗时；只再等一小段，
+                        # 仍未就绪就把 Future 挂到 session_state，下一轮开头收割——
+                        # Layer 3 彻底退出本轮关键路径
+                        try:
+                            evaluation_output = eval_future.result(
+                                timeout=float(config.get("layer3_wait_seconds", 5)))
+                        except FutureTimeoutError:
+                            st.session_state.pending_eval_future = eval_future
+                            st.session_state.pending_eval_idx = len(st.session_state.messages)
+                            evaluation_output = (
+                                "【分析】Layer 3 评估仍在后台进行，结果将在下一轮并入策略。\n"
+                                "【回款可能性】MEDIUM"
+                            )
+
+                with st.expander("🛡️ Layer 3 Evaluation", expanded=True):
+                    st.caption(evaluation_output)
+
+            # 6. 检查是否需要更新策略。规则分诊只给出粗判，没有真实的分析文本可喂给
+            #    Layer 1——用占位 stub 改写策略等于凭空重写，还要再付一次 Layer 2 重生成，
+            #    比省下的那次评估更贵；triage 轮不触发更新，LOW 交给下一次 LLM 评估确认
+            is_low_prob = triage_verdict is None and is_low_probability(evaluation_output)
+
+            layer1_update_text = None
+            if is_low_prob:
+                with col_info:
+                    with st.spinner("⚠️ Low probability! Updating Strategy..."):
+                        new_strategy = layer1.update_strategy(
+                            st.session_state.strategy,
+                            evaluation_output,
+                            prompt,
+                            customer_profile
+                        )
+                        st.session_state.strategy = new_strategy
+                        layer1_update_text = new_strategy
+                        st.warning("🔄 Strategy Updated!")
+                        with st.expander("View New Strategy"):
+                            st.caption(new_strategy)
+
+                # 推测未命中：用新策略重新生成回复，覆盖旧气泡
+                exec_result = {}
+                with response_slot.container():
+                    st.write_stream(layer2.execute_stream(
+                        st.session_state.strategy,
+                        recent_messages[:-1],
+                        prompt,
+                        history_logs,
+                        memory_context,
+                        result=exec_result
+                    ))
+                response = exec_result.get("response", "")
+                thought = exec_result.get("thought", "")
+
+            # 8. 思考过程（流结束后才可用）
+            with col_info:
                 with st.expander("🕵️ Layer 2 Execution Monitor (Thought)", expanded=True):
                     st.write(thought)
                 st.divider()
         
-        # 8. 输出响应
-        with col_chat:
-            with st.chat_message("assistant"):
-                st.write(response)
-        
-        # 9. 保存到历史
-        st.session_state.messages.append({
-            "role": "assistant", 
-            "content": response, 
-            "thought": thought,
-            "layer3_evaluation": evaluation_output,
-            "layer1_update": layer1_update_text
-        })
-        
-        st.rerun()
-
-    
+            # 9. 保存到历史
+            append_message("assistant", response)
+            st.session_state.analyses[len(st.session_state.messages) - 1] = {
+                "thought": thought,
+                "layer3_evaluation": evaluation_output,
+                "layer1_update": layer1_update_text,
+            }
+            # 不再 st.rerun()：本轮的用户消息、流式回复与分析面板都已在上面原位渲染，
+            # 强制整页重跑只会把同样的内容再画一遍、把感知延迟翻倍；
+            # 右侧记忆/策略面板由下一次交互（fragment 级重跑）自然刷新
 
+    if _fragment is not None:
+        chat_area = _fragment(chat_area)
+    chat_area()
 
 
 if __name__ == "__main__":
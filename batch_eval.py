@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+"""
+离线批量评估（OpenAI Batch API）：用于 prompt/温度变体的回归跑批，不走在线聊天路径。
+
+相比循环调用同步接口（O(N * RTT)），Batch API 以 50% 的输入/输出价格异步处理，
+吞吐高得多，适合对大量客户画像做 Layer 1 策略生成的开发迭代。
+
+用法：
+    # 1. 由画像文件构建 batch 输入（每行 {"customer_profile": {...}, "history_logs": "..."}）
+    python batch_eval.py build profiles.jsonl batch_input.jsonl [--temperature 0.7]
+    # 2. 上传并提交 batch
+    python batch_eval.py submit batch_input.jsonl
+    # 3. 轮询状态
+    python batch_eval.py poll <batch_id>
+    # 4. 下载结果（按 custom_id 与输入 join）
+    python batch_eval.py fetch <batch_id> results.jsonl
+"""
+import argparse
+import hashlib
+import json
+import os
+import sys
+import time
+
+from openai import OpenAI
+
+MODEL_NAME = "gpt-4o-mini"
+
+# 与 app_easy.Layer1StrategyManager.generate_initial_strategy 保持一致的提示词
+# （独立副本：app_easy 是 Streamlit 脚本，import 会触发页面副作用）
+LAYER1_INIT_SYSTEM_PROMPT = "你是催收策略经理。根据客户信息、历史记录以及公司的基础配置规则，制定今天的催收策略。"
+
+LAYER1_INIT_USER_TEMPLATE = """
+        客户资料：{profile_json}
+        客户资料将有助于你分析客户当前的经济能力
+
+        历史记录：{history_json}
+        基于此记忆体，我们能总结出我们每天与客户交流的内，客户的还款意愿与还款能力吗？客户拒绝还款的理由是否合理
+
+        *** 关键约束 ***
+        目标：尽快拿回钱。
+
+        请按以下格式输出：
+
+        【历史分析】
+        （在此处简要分析客户昨天的态度、承诺、还款能力和意愿）
+
+        【今日临时催收策略】
+        1. 沟通基调：...
+        2. 重点强调的内容：...
+        """
+
+
+def profile_hash(customer_profile) -> str:
+    raw = json.dumps(customer_profile, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()[:12]
+
+
+def build(profiles_path: str, out_path: str, temperature: float):
+    n = 0
+    with open(profiles_path, "r", encoding="utf-8") as fin, \
+            open(out_path, "w", encoding="utf-8") as fout:
+        for line in fin:
+            line = line.strip()
+            if not line:
+                continue
+            row = json.loads(line)
+            profile = row["customer_profile"]
+            user_prompt = LAYER1_INIT_USER_TEMPLATE.format(
+                profile_json=json.dumps(profile, ensure_ascii=False),
+                history_json=json.dumps(row.get("history_logs", ""), ensure_ascii=False),
+            )
+            entry = {
+                "custom_id": f"{profile_hash(profile)}-layer1",
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": {
+                    "model": MODEL_NAME,
+                    "messages": [
+                        {"role": "system", "content": LAYER1_INIT_SYSTEM_PROMPT},
+                        {"role": "user", "content": user_prompt},
+                    ],
+                    "temperature": temperature,
+                },
+            }
+            fout.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            n += 1
+    print(f"Wrote {n} batch entries to {out_path}")
+
+
+def submit(client: OpenAI, input_path: str):
+    with open(input_path, "rb") as f:
+        uploaded = client.files.create(file=f, purpose="batch")
+    batch = client.batches.create(
+        input_file_id=uploaded.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h",
+    )
+    print(f"Submitted batch: {batch.id} (status={batch.status})")
+
+
+def poll(client: OpenAI, batch_id: str):
+    while True:
+        batch = client.batches.retrieve(batch_id)
+        print(f"[{time.strftime('%H:%M:%S')}] {batch.id}: {batch.status} "
+              f"(completed={batch.request_counts.completed}/{batch.request_counts.total})")
+        if batch.status in ("completed", "failed", "expired", "cancelled"):
+            return
+        time.sleep(30)
+
+
+def fetch(client: OpenAI, batch_id: str, out_path: str):
+    batch = client.batches.retrieve(batch_id)
+    if not batch.output_file_id:
+        sys.exit(f"Batch {batch_id} has no output yet (status={batch.status})")
+    content = client.files.content(batch.output_file_id)
+    with open(out_path, "wb") as f:
+        f.write(content.read())
+    print(f"Saved results to {out_path}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="cmd", required=True)
+
+    p_build = sub.add_parser("build")
+    p_build.add_argument("profiles")
+    p_build.add_argument("output")
+    p_build.add_argument("--temperature", type=float, default=0.7)
+
+    p_submit = sub.add_parser("submit")
+    p_submit.add_argument("input")
+
+    p_poll = sub.add_parser("poll")
+    p_poll.add_argument("batch_id")
+
+    p_fetch = sub.add_parser("fetch")
+    p_fetch.add_argument("batch_id")
+    p_fetch.add_argument("output")
+
+    args = parser.parse_args()
+    if args.cmd == "build":
+        build(args.profiles, args.output, args.temperature)
+        return
+
+    client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"), base_url=os.getenv("OPENAI_BASE_URL"))
+    if args.cmd == "submit":
+        submit(client, args.input)
+    elif args.cmd == "poll":
+        poll(client, args.batch_id)
+    elif args.cmd == "fetch":
+        fetch(client, args.batch_id, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""共享的 OpenAI 客户端工厂，供各原型脚本 import。
+
+每轮对话要连续打 2-3 次 chat.completions，默认客户端的连接池偏小时会出现
+重复 TCP/TLS 握手（冷区域每次 ~100-300ms）。这里统一配置 httpx 连接池与
+keepalive，让同一进程内的所有调用复用同一条连接。
+"""
+import os
+import threading
+import time
+
+import httpx
+from openai import OpenAI
+
+_client = None
+
+
+def get_client() -> OpenAI:
+    """进程内单例；重复调用返回同一个带连接池的客户端。"""
+    global _client
+    if _client is None:
+        _client = OpenAI(
+            api_key=os.getenv("OPENAI_API_KEY"),
+            base_url=os.getenv("OPENAI_BASE_URL"),
+            http_client=httpx.Client(
+                limits=httpx.Limits(
+                    max_keepalive_connections=20,
+                    max_connections=40,
+                    keepalive_expiry=30.0,
+                ),
+                timeout=httpx.Timeout(60.0, connect=5.0),
+            ),
+        )
+    return _client
+
+
+def _env_float(name):
+    raw = os.getenv(name)
+    try:
+        return float(raw) if raw else None
+    except ValueError:
+        return None
+
+
+def estimate_tokens(text: str) -> int:
+    """粗估 token 数（约 4 字符/token），热路径上不值得上 tiktoken。"""
+    return len(text) // 4 + 1
+
+
+class RateLimiter:
+    """线程安全的令牌桶，按 RPM/TPM 限速。
+
+    并行化之后的调用突发会撞账号的 429 上限，重试反而吃掉加速收益；
+    在每次请求前 acquire，超出预算时阻塞等待桶回填。未配置上限时为空操作。
+    """
+
+    def __init__(self, rpm=None, tpm=None):
+        self._lock = threading.Lock()
+        self._rpm = rpm
+        self._tpm = tpm
+        self._req_budget = rpm or 0.0
+        self._tok_budget = tpm or 0.0
+        self._last = time.monotonic()
+
+    def acquire(self, est_tokens: int = 0):
+        if not self._rpm and not self._tpm:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                elapsed_min = (now - self._last) / 60.0
+                self._last = now
+                if self._rpm:
+                    self._req_budget = min(self._rpm, self._req_budget + elapsed_min * self._rpm)
+                if self._tpm:
+                    self._tok_budget = min(self._tpm, self._tok_budget + elapsed_min * self._tpm)
+                wait = 0.0
+                if self._rpm and self._req_budget < 1.0:
+                    wait = max(wait, (1.0 - self._req_budget) / self._rpm * 60.0)
+                if self._tpm and est_tokens and self._tok_budget < est_tokens:
+                    wait = max(wait, (est_tokens - self._tok_budget) / self._tpm * 60.0)
+                if wait == 0.0:
+                    if self._rpm:
+                        self._req_budget -= 1.0
+                    if self._tpm:
+                        self._tok_budget -= est_tokens
+                    return
+            time.sleep(min(wait, 1.0))
+
+
+_limiter = None
+
+
+def get_rate_limiter() -> RateLimiter:
+    """进程内单例；上限由环境变量 OPENAI_RPM / OPENAI_TPM 配置。"""
+    global _limiter
+    if _limiter is None:
+        _limiter = RateLimiter(rpm=_env_float("OPENAI_RPM"), tpm=_env_float("OPENAI_TPM"))
+    return _limiter
@@ -16,39 +16,59 @@ MODELS_TO_TEST = [
     "ernie-bot"
 ]
 
-async def test_models():
-    """测试多个百度ERNIE模型是否可用"""
+# 单个探测的超时时间（秒），避免个别模型挂起拖慢整体
+PROBE_TIMEOUT = 10
+
 
-    for model in MODELS_TO_TEST:
-        try:
-            print(f"\n🧪 测试模型: {model}")
-            client = AsyncOpenAI(api_key=BAIDU_API_KEY, base_url=BAIDU_BASE_URL)
+async def probe(client: AsyncOpenAI, model: str):
+    """探测单个模型，返回响应；失败时抛出异常由 gather 收集"""
+    return await asyncio.wait_for(
+        client.chat.completions.create(
+            model=model,
+            messages=[{"role": "user", "content": "你好"}],
+            temperature=0.7
+        ),
+        timeout=PROBE_TIMEOUT,
+    )
 
-            response = await client.chat.completions.create(
-                model=model,
-                messages=[{"role": "user", "content": "你好"}],
-                temperature=0.7
-            )
 
-            print(f"✅ 模型 {model} 可用!")
-            print(f"📝 响应预览: {response.choices[0].message.content[:50]}...")
+async def test_models():
+    """并发测试多个百度ERNIE模型是否可用（总耗时约等于最慢的一次探测）"""
 
-            # 找到第一个可用模型
-            print(f"\n🎉 推荐使用模型: {model}")
-            return model
+    # 共享一个客户端，复用连接池，避免每个模型重复 TLS 握手
+    client = AsyncOpenAI(api_key=BAIDU_API_KEY, base_url=BAIDU_BASE_URL)
 
-        except Exception as e:
-            error_str = str(e)
-            if "invalid_model" in error_str:
+    results = await asyncio.gather(
+        *(probe(client, m) for m in MODELS_TO_TEST),
+        return_exceptions=True,
+    )
+
+    first_ok = None
+    for model, result in zip(MODELS_TO_TEST, results):
+        print(f"\n🧪 测试模型: {model}")
+        if isinstance(result, Exception):
+            error_str = str(result)
+            if isinstance(result, asyncio.TimeoutError):
+                print(f"⏱️ 模型 {model} 探测超时（>{PROBE_TIMEOUT}s）")
+            elif "invalid_model" in error_str:
                 print(f"❌ 模型 {model} 不存在或无访问权限")
             elif "401" in error_str:
                 print(f"🔑 认证失败 - 需要检查API Key")
             else:
                 print(f"⚠️  测试失败: {error_str}")
+            continue
+
+        print(f"✅ 模型 {model} 可用!")
+        print(f"📝 响应预览: {result.choices[0].message.content[:50]}...")
+        if first_ok is None:
+            first_ok = model
 
-    print("\n⚠️ 没有找到可用的ERNIE模型！")
-    return None
+    if first_ok:
+        print(f"\n🎉 推荐使用模型: {first_ok}")
+    else:
+        print("\n⚠️ 没有找到可用的ERNIE模型！")
+    return first_ok
 
 if __name__ == "__main__":
     print("🎯 正在测试百度ERNIE模型的可用性...")
-    _, _, _ = asyncio.run(test_models())
\ No newline at end of file
+    asyncio.run(test_models())
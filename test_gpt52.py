@@ -1,12 +1,30 @@
 import os
 import json
 import datetime as dt
+import functools
+from concurrent.futures import ThreadPoolExecutor
 from typing import Literal, List, Dict, Any, Optional
 
 import streamlit as st
 from pydantic import BaseModel, Field
 from openai import OpenAI
 
+from llm_client import estimate_tokens, get_client, get_rate_limiter
+
+try:
+    import orjson
+
+    def _dumps(obj) -> str:
+        # orjson is ~3-5x faster than stdlib json on these dict payloads
+        return orjson.dumps(obj).decode("utf-8")
+
+    _loads = orjson.loads
+except ImportError:
+    def _dumps(obj) -> str:
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+
+    _loads = json.loads
+
 # =========================================================
 # Config
 # =========================================================
@@ -22,8 +40,18 @@ from openai import OpenAI
 
 MODEL = "gpt-5.2" 
 
-# OpenAI client (expects OPENAI_API_KEY env var)
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+# 每次调用只携带最近 N 条对话，更早上下文由 memory_state 承载
+DIALOGUE_WINDOW = 12
+
+# Shared pooled OpenAI client (expects OPENAI_API_KEY env var)
+client = get_client()
+
+
+@st.cache_resource
+def get_worker_pool() -> ThreadPoolExecutor:
+    # Shared pool for overlapping critic/executor calls; cached so Streamlit
+    # reruns reuse the same threads instead of spawning a new pool each time.
+    return ThreadPoolExecutor(max_workers=2)
 
 
 # =========================================================
@@ -95,23 +123,26 @@ class StrategyCard(BaseModel):
 
 
 def _forbid_additional_props(schema_node):
-    """Recursively set additionalProperties=false for all object nodes."""
-    if isinstance(schema_node, dict):
-        if schema_node.get("type") == "object":
-            schema_node.setdefault("additionalProperties", False)
-        for v in schema_node.values():
-            _forbid_additional_props(v)
-    elif isinstance(schema_node, list):
-        for x in schema_node:
-            _forbid_additional_props(x)
-
-
+    """Set additionalProperties=false for all object nodes (iterative walk)."""
+    stack = [schema_node]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, dict):
+            if node.get("type") == "object":
+                node.setdefault("additionalProperties", False)
+            stack.extend(node.values())
+        elif isinstance(node, list):
+            stack.extend(node)
+
+
+@functools.lru_cache(maxsize=None)
 def critic_json_schema() -> dict:
     schema = CriticResult.model_json_schema()
     _forbid_additional_props(schema)
     return {"name": "critic_result", "strict": True, "schema": schema}
 
 
+@functools.lru_cache(maxsize=None)
 def meta_strategy_json_schema() -> dict:
     schema = StrategyCard.model_json_schema()
     _forbid_additional_props(schema)
@@ -174,17 +205,35 @@ def build_executor_system_prompt() -> str:
 """
 
 
+# System prompts are pure constants — build once at import so every call
+# reuses byte-identical strings (required for OpenAI automatic prompt caching).
+CRITIC_SYSTEM_PROMPT = build_critic_system_prompt()
+META_SYSTEM_PROMPT = build_meta_system_prompt()
+EXECUTOR_SYSTEM_PROMPT = build_executor_system_prompt()
+
+# Static task preambles, kept as separate stable messages ahead of the
+# per-turn payload. Messages are ordered by volatility (static instructions,
+# then slow-moving state, then the dialogue window) so the cached prefix
+# survives as long as possible across turns.
+CRITIC_TASK_PREAMBLE = "请评估并输出JSON。输入分两段：先是strategy_card与memory_state，然后是recent_dialogue。"
+META_TASK_PREAMBLE = "请生成新的strategy_card JSON。输入分两段：先是memory_state与critic_result，然后是recent_dialogue。"
+EXECUTOR_TASK_PREAMBLE = "请基于以下信息生成下一条发给用户的话术。输入分两段：先是strategy_card/memory_state/micro_edits，然后是recent_dialogue。"
+
+
 # =========================================================
 # LLM helpers
 # =========================================================
-def call_llm_text(system: str, user: str, temperature: float = 0.2) -> str:
+def _throttle(messages: List[Dict[str, str]]):
+    # 令牌桶限速：防止 critic/executor 并发突发撞 429 后反被重试拖慢
+    get_rate_limiter().acquire(estimate_tokens("".join(m["content"] for m in messages)))
+
+
+def call_llm_messages(messages: List[Dict[str, str]], temperature: float = 0.2) -> str:
     try:
+        _throttle(messages)
         resp = client.chat.completions.create(
             model=MODEL,
-            messages=[
-                {"role": "system", "content": system},
-                {"role": "user", "content": user},
-            ],
+            messages=messages,
             temperature=temperature,
         )
         return resp.choices[0].message.content.strip()
@@ -192,38 +241,47 @@ def call_llm_text(system: str, user: str, temperature: float = 0.2) -> str:
         return f"LLM Error: {e}"
 
 
-def call_critic(strategy_card: Dict[str, Any], memory_state: Dict[str, Any], dialogue: List[Dict[str, str]]) -> CriticResult:
-    system = build_critic_system_prompt()
-    payload = {
-        "strategy_card": strategy_card,
-        "memory_state": memory_state,
-        "recent_dialogue": dialogue[-12:],
-    }
-    user = "请评估并输出JSON：\n" + json.dumps(payload, ensure_ascii=False)
+def call_llm_text(system: str, user: str, temperature: float = 0.2) -> str:
+    return call_llm_messages(
+        [
+            {"role": "system", "content": system},
+            {"role": "user", "content": user},
+        ],
+        temperature=temperature,
+    )
+
 
+def call_critic(sc_blob: str, mem_blob: str, dlg_blob: str) -> CriticResult:
+    # Takes pre-serialized JSON fragments so the same turn's critic/meta/
+    # executor calls don't each re-dump strategy_card/memory_state/dialogue.
     # Preferred: JSON schema structured outputs
     try:
+        messages = [
+            {"role": "system", "content": CRITIC_SYSTEM_PROMPT},
+            {"role": "user", "content": CRITIC_TASK_PREAMBLE},
+            {"role": "user", "content": f'{{"strategy_card": {sc_blob}, "memory_state": {mem_blob}}}'},
+            {"role": "user", "content": f'{{"recent_dialogue": {dlg_blob}}}'},
+        ]
+        _throttle(messages)
         resp = client.chat.completions.create(
             model=MODEL,
-            messages=[
-                {"role": "system", "content": system},
-                {"role": "user", "content": user},
-            ],
+            messages=messages,
             temperature=0.0,
             response_format={
                 "type": "json_object"
             }
         )
-        data = json.loads(resp.choices[0].message.content)
+        data = _loads(resp.choices[0].message.content)
         return CriticResult(**data)
     except Exception as e:
         # Fallback: best-effort JSON + validation
         st.error(f"Critic Error: {e}")
-        return CriticResult(
+        # Fallback fields are trusted literals; model_construct skips validation
+        return CriticResult.model_construct(
             decision="ESCALATE_TO_META",
             decision_reason=f"critic_failed: {str(e)[:90]}",
             reason_codes=["critic_failed"],
-            micro_edits_for_executor=MicroEdits(
+            micro_edits_for_executor=MicroEdits.model_construct(
                 ask_style="forced_choice",
                 confirmation_format="amount_time_today",
                 tone="polite_firm",
@@ -232,29 +290,25 @@ def call_critic(strategy_card: Dict[str, Any], memory_state: Dict[str, Any], dia
         )
 
 
-def call_meta(memory_state: Dict[str, Any], critic: CriticResult, dialogue: List[Dict[str, str]]) -> Dict[str, Any]:
-    system = build_meta_system_prompt()
-    payload = {
-        "memory_state": memory_state,
-        "critic_result": critic.model_dump(),
-        "recent_dialogue": dialogue[-12:],
-    }
-    user = "请生成新的strategy_card JSON：\n" + json.dumps(payload, ensure_ascii=False)
-
+def call_meta(memory_state: Dict[str, Any], mem_blob: str, critic: CriticResult, dlg_blob: str) -> Dict[str, Any]:
     # Preferred: JSON schema structured outputs
     try:
+        messages = [
+            {"role": "system", "content": META_SYSTEM_PROMPT},
+            {"role": "user", "content": META_TASK_PREAMBLE},
+            {"role": "user", "content": f'{{"memory_state": {mem_blob}, "critic_result": {_dumps(critic.model_dump())}}}'},
+            {"role": "user", "content": f'{{"recent_dialogue": {dlg_blob}}}'},
+        ]
+        _throttle(messages)
         resp = client.chat.completions.create(
             model=MODEL,
-            messages=[
-                {"role": "system", "content": system},
-                {"role": "user", "content": user},
-            ],
+            messages=messages,
             temperature=0.0,
             response_format={
                 "type": "json_object"
             }
         )
-        data = json.loads(resp.choices[0].message.content)
+        data = _loads(resp.choices[0].message.content)
         sc = StrategyCard(**data)
 
         # Hard alignment: stage must match memory_state.stage
@@ -270,7 +324,7 @@ def call_meta(memory_state: Dict[str, Any], critic: CriticResult, dialogue: List
         st.error(f"Meta Error: {e}")
         dpd = int(memory_state.get("dpd", 0))
         stage = memory_state.get("stage", dpd_to_stage(dpd))
-        fallback = StrategyCard(
+        fallback = StrategyCard.model_construct(
             strategy_id="fallback_strategy",
             stage=stage,
             today_kpi=["payment_today_or_extension_today"] if dpd >= 0 else ["confirm_plan"],
@@ -284,16 +338,45 @@ def call_meta(memory_state: Dict[str, Any], critic: CriticResult, dialogue: List
         return fallback.model_dump()
 
 
-def call_executor(strategy_card: Dict[str, Any], memory_state: Dict[str, Any], dialogue: List[Dict[str, str]], micro: MicroEdits) -> str:
-    system = build_executor_system_prompt()
-    payload = {
-        "strategy_card": strategy_card,
-        "memory_state": memory_state,
-        "micro_edits": micro.model_dump(),
-        "recent_dialogue": dialogue[-12:],
-    }
-    user = "请基于以下信息生成下一条发给用户的话术：\n" + json.dumps(payload, ensure_ascii=False)
-    return call_llm_text(system, user, temperature=0.2)
+def call_executor_stream(sc_blob: str, mem_blob: str, dlg_blob: str, micro: MicroEdits):
+    """Issue the executor call with stream=True and return a delta-text generator.
+
+    The request is sent when this function runs (so it can be fired from the
+    worker pool speculatively); the returned generator is consumed on the main
+    thread, e.g. by st.write_stream.
+    """
+    messages = [
+        {"role": "system", "content": EXECUTOR_SYSTEM_PROMPT},
+        {"role": "user", "content": EXECUTOR_TASK_PREAMBLE},
+        {"role": "user", "content": f'{{"strategy_card": {sc_blob}, "memory_state": {mem_blob}, '
+                                    f'"micro_edits": {_dumps(micro.model_dump())}}}'},
+        {"role": "user", "content": f'{{"recent_dialogue": {dlg_blob}}}'},
+    ]
+    try:
+        _throttle(messages)
+        resp = client.chat.completions.create(
+            model=MODEL,
+            messages=messages,
+            temperature=0.2,
+            stream=True,
+        )
+    except Exception as e:
+        resp = None
+        error = f"LLM Error: {e}"
+
+    def _gen():
+        if resp is None:
+            yield error
+            return
+        try:
+            for chunk in resp:
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    yield delta
+        except Exception as e:
+            yield f"\nLLM Error: {e}"
+
+    return _gen()
 
 
 # =========================================================
@@ -302,19 +385,25 @@ def call_executor(strategy_card: Dict[str, Any], memory_state: Dict[str, Any], d
 def apply_memory_write(memory: Dict[str, Any], memory_write: Dict[str, Any]) -> Dict[str, Any]:
     if not memory_write:
         return memory
-    merged = dict(memory)
-    for k, v in memory_write.items():
-        if isinstance(v, dict) and isinstance(merged.get(k), dict):
-            merged[k] = {**merged[k], **v}
-        else:
-            merged[k] = v
+    # Plain top-level overwrites are the majority: handle them with one
+    # C-level dict union, then patch the rare dict-into-dict keys on top.
+    nested = {k: v for k, v in memory_write.items()
+              if isinstance(v, dict) and isinstance(memory.get(k), dict)}
+    merged = memory | {k: v for k, v in memory_write.items() if k not in nested}
+    for k, v in nested.items():
+        merged[k] = memory[k] | v
     return merged
 
 
-def ensure_strategy_card(memory_state: Dict[str, Any], strategy_card: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+@functools.lru_cache(maxsize=64)
+def _ensure_strategy_card_cached(mem_key: str, sc_key: str) -> str:
+    # Keyed on serialized content so Streamlit reruns with unchanged state
+    # (the right-hand panel re-validates every repaint) skip Pydantic work.
+    memory_state = _loads(mem_key)
+    strategy_card = _loads(sc_key) if sc_key else None
     if strategy_card:
         try:
-            return StrategyCard(**strategy_card).model_dump()
+            return _dumps(StrategyCard(**strategy_card).model_dump())
         except Exception:
             pass
 
@@ -331,7 +420,12 @@ def ensure_strategy_card(memory_state: Dict[str, Any], strategy_card: Optional[D
         escalation_actions_allowed={},
         params={}
     )
-    return sc.model_dump()
+    return _dumps(sc.model_dump())
+
+
+def ensure_strategy_card(memory_state: Dict[str, Any], strategy_card: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    return _loads(_ensure_strategy_card_cached(
+        _dumps(memory_state), _dumps(strategy_card) if strategy_card else ""))
 
 
 # =========================================================
@@ -353,24 +447,55 @@ def handle_turn(user_msg: str):
     # Ensure strategy exists
     st.session_state.strategy_card = ensure_strategy_card(st.session_state.memory_state, st.session_state.strategy_card)
 
-    # 1) Critic (Gate)
-    critic = call_critic(st.session_state.strategy_card, st.session_state.memory_state, st.session_state.dialogue)
+    # 1) Critic (Gate) + speculative Executor draft in parallel.
+    # Both are blocking LLM calls; on the dominant CONTINUE path the turn
+    # costs max(t_critic, t_exec) instead of their sum. The draft assumes
+    # default micro-edits and the pre-critic memory/strategy snapshot.
+    pool = get_worker_pool()
+    default_micro = MicroEdits()
+
+    # Serialize the shared payload pieces once per turn; the blobs double as
+    # immutable snapshots for the speculative executor call.
+    sc_blob = _dumps(st.session_state.strategy_card)
+    mem_blob = _dumps(st.session_state.memory_state)
+    dlg_blob = _dumps(st.session_state.dialogue[-DIALOGUE_WINDOW:])
+
+    spec_future = pool.submit(call_executor_stream, sc_blob, mem_blob, dlg_blob, default_micro)
+
+    critic = call_critic(sc_blob, mem_blob, dlg_blob)
     st.session_state.last_critic = critic.model_dump()
 
-    # 2) Apply critic memory writes
-    st.session_state.memory_state = apply_memory_write(st.session_state.memory_state, critic.memory_write)
+    # 2) Apply critic memory writes (re-serialize only when something changed)
+    if critic.memory_write:
+        st.session_state.memory_state = apply_memory_write(st.session_state.memory_state, critic.memory_write)
+        mem_blob = _dumps(st.session_state.memory_state)
 
     # 3) Meta rewrite strategy if needed
     if critic.decision == "ESCALATE_TO_META":
-        st.session_state.strategy_card = call_meta(st.session_state.memory_state, critic, st.session_state.dialogue)
-
-    # 4) Executor response
-    reply = call_executor(
-        st.session_state.strategy_card,
-        st.session_state.memory_state,
-        st.session_state.dialogue,
-        critic.micro_edits_for_executor
+        st.session_state.strategy_card = call_meta(st.session_state.memory_state, mem_blob, critic, dlg_blob)
+        sc_blob = _dumps(st.session_state.strategy_card)
+
+    # 4) Executor response: the speculative draft is only valid when the
+    # critic changed nothing the executor consumes; otherwise discard it
+    # and re-issue with the updated strategy/memory/micro-edits.
+    speculation_valid = (
+        critic.decision == "CONTINUE"
+        and not critic.memory_write
+        and critic.micro_edits_for_executor == default_micro
     )
+    if speculation_valid:
+        reply_stream = spec_future.result()
+    else:
+        spec_future.cancel()
+        reply_stream = call_executor_stream(sc_blob, mem_blob, dlg_blob, critic.micro_edits_for_executor)
+
+    # Stream tokens into a placeholder as they arrive; the post-turn rerun
+    # repaints the final text through the normal dialogue loop.
+    slot = st.empty()
+    with slot.container():
+        st.markdown("**机构（生成中）：**")
+        reply = st.write_stream(reply_stream)
+    slot.empty()
     st.session_state.dialogue.append({"role": "assistant", "content": reply})
 
 
@@ -1,20 +1,56 @@
 import os
 import json
 import datetime as dt
+import functools
+import logging
+import re
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from typing import Literal, List, Dict, Any, Optional
 
 import streamlit as st
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, TypeAdapter
 from openai import OpenAI
 
+from llm_client import estimate_tokens, get_client, get_rate_limiter
+
+log = logging.getLogger(__name__)
+
+try:
+    import orjson
+
+    def _dumps(obj) -> str:
+        # 中文为主的 payload 上 orjson 比 stdlib json 快 3-10 倍
+        return orjson.dumps(obj).decode("utf-8")
+
+    _loads = orjson.loads
+except ImportError:
+    def _dumps(obj) -> str:
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+
+    _loads = json.loads
+
 # =========================================================
 # Config
 # =========================================================
 # If your actual model name differs, change this.
 MODEL = "gpt-5-mini"
 
-# OpenAI client (expects OPENAI_API_KEY env var)
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+# 每次调用只携带最近 N 条对话；完整对话仅用于 UI 渲染与审计
+DIALOGUE_WINDOW = 12
+
+# Shared pooled OpenAI client (expects OPENAI_API_KEY env var)
+client = get_client()
+
+# 推测执行开关：critic 与 executor 并行，约两成轮次会作废重打、token 翻倍，
+# 预算紧张时可用 SPECULATIVE_EXECUTOR=0 关闭
+_SPECULATE = os.getenv("SPECULATIVE_EXECUTOR", "1") != "0"
+
+
+@st.cache_resource
+def get_worker_pool() -> ThreadPoolExecutor:
+    return ThreadPoolExecutor(max_workers=2)
 
 
 # =========================================================
@@ -25,6 +61,12 @@ def dpd_to_stage(dpd: int) -> str:
     return calculate_stage(dpd, 0, 0)
 
 
+_STAGE_TABLE = ("Stage1", "Stage2", "Stage3", "Stage4")
+
+
+# 有意保持纯 Python：曾考虑过 numba JIT 并否决——本函数每个 UI 轮次只调一次，
+# 几次乘加的收益远小于 JIT 首调的秒级预热成本；用上面的 lru_cache 查表即可。
+@functools.lru_cache(maxsize=8192)
 def calculate_stage(dpd: int, broken_promises: int = 0, payment_refusals: int = 0) -> str:
     """
     综合计算 Stage，考虑三个因素：
@@ -42,22 +84,15 @@ def calculate_stage(dpd: int, broken_promises: int = 0, payment_refusals: int =
         return "Stage0"
     
     # 计算风险评分
-    dpd_score = dpd * 10
-    promise_score = broken_promises * 15
-    refusal_score = payment_refusals * 20
-    total_score = dpd_score + promise_score + refusal_score
-    
-    # Stage 映射
+    total_score = dpd * 10 + broken_promises * 15 + payment_refusals * 20
+
+    # Stage 映射：0 分无不良记录，其余按每 30 分一档查表（封顶 Stage4）
     if total_score == 0:
-        return "Stage1"  # 到期日，无不良记录
-    elif total_score < 30:
-        return "Stage2"  # 轻度风险
-    elif total_score < 60:
-        return "Stage3"  # 中度风险
-    else:
-        return "Stage4"  # 高风险
+        return "Stage1"
+    return _STAGE_TABLE[min(total_score // 30 + 1, 3)]
 
 
+@functools.lru_cache(maxsize=1024)
 def sop_trigger_named_escalation(dpd: int, broken_promises: int) -> bool:
     # Your SOP trigger: broken_promises>=1 and dpd>3
     return (broken_promises >= 1 and dpd > 3)
@@ -110,30 +145,44 @@ class StrategyCard(BaseModel):
     notes: Optional[str] = None
 
 
-def _forbid_additional_props(schema_node):
-    """Recursively set additionalProperties=false for all object nodes."""
-    if isinstance(schema_node, dict):
-        if schema_node.get("type") == "object":
-            schema_node.setdefault("additionalProperties", False)
-        for v in schema_node.values():
-            _forbid_additional_props(v)
-    elif isinstance(schema_node, list):
-        for x in schema_node:
-            _forbid_additional_props(x)
+# 热路径校验走模块级 TypeAdapter：validate_python 省掉每次 __init__ 入口的
+# 参数整理开销，core schema 也只构建一次
+_CRITIC_ADAPTER = TypeAdapter(CriticResult)
+_STRATEGY_ADAPTER = TypeAdapter(StrategyCard)
 
 
+def _forbid_additional_props(schema_node):
+    """Set additionalProperties=false for all object nodes (iterative walk)."""
+    stack = [schema_node]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, dict):
+            if node.get("type") == "object":
+                node.setdefault("additionalProperties", False)
+            stack.extend(node.values())
+        elif isinstance(node, list):
+            stack.extend(node)
+
+
+@functools.lru_cache(maxsize=None)
 def critic_json_schema() -> dict:
     schema = CriticResult.model_json_schema()
     _forbid_additional_props(schema)
     return {"name": "critic_result", "strict": True, "schema": schema}
 
 
+@functools.lru_cache(maxsize=None)
 def meta_strategy_json_schema() -> dict:
     schema = StrategyCard.model_json_schema()
     _forbid_additional_props(schema)
     return {"name": "strategy_card", "strict": True, "schema": schema}
 
 
+# 导入时预热缓存：schema 生成与遍历只在进程启动时发生一次
+critic_json_schema()
+meta_strategy_json_schema()
+
+
 # =========================================================
 # Prompt Templates
 # =========================================================
@@ -233,37 +282,35 @@ def build_meta_system_prompt() -> str:
 
 
 
-def build_executor_system_prompt(org_name: str, memory_state: Dict[str, Any], strategy_card: Dict[str, Any], history_summary: str) -> str:
+def build_executor_context(org_name: str, memory_state: Dict[str, Any], strategy_card: Dict[str, Any], history_summary: str) -> str:
+    """每轮变化的策略/记忆块。拼进 user 消息而非 system：
+    system 前缀保持字节级不变才能命中 OpenAI 自动 prompt caching。"""
     # 提取策略关键信息
     stage = strategy_card.get("stage", "Unknown")
     pressure = strategy_card.get("pressure_level", "polite")
     kpis = strategy_card.get("today_kpi", [])
     allowed_acts = strategy_card.get("allowed_actions", [])
     guardrails = strategy_card.get("guardrails", [])
-    
-    # 动态构建策略指令
-    strategy_instruction = f"""
+
+    return f"""【机构】{org_name}
+
     【当前策略状态】
     - 阶段: {stage}
     - 施压等级: {pressure} (决定你的语气强硬度)
     - 今日KPI (你的核心目标): {', '.join(kpis)}
     - 允许的动作: {', '.join(allowed_acts)}
     - 必须遵守的红线: {', '.join(guardrails)}
-    """
 
-    # 记忆与上下文指令
-    context_instruction = f"""
     【用户记忆档案】
     - 逾期天数: {memory_state.get('dpd')} (正数表示已逾期)
     - 失约次数: {memory_state.get('broken_promises')} (次数越多，你越不应轻信新的非即时承诺)
     - 历史摘要: {history_summary or "暂无历史"} (这是用户过去的表现，如果用户重复之前的借口，必须当场揭穿)
     """
 
-    return f"""你是{org_name}负责该账户的还款跟进人员，通过WhatsApp沟通（此处用中文输出）。
-
-{strategy_instruction}
 
-{context_instruction}
+# 静态 system 前缀：机构名/策略/记忆全部移入 user 消息，保证跨轮字节一致
+EXECUTOR_STATIC_SYSTEM_PROMPT = """你是负责该账户的还款跟进人员，通过WhatsApp沟通（此处用中文输出）。
+机构名称、当前策略状态与用户记忆档案在随后的用户消息中给出。
 
 执行催收strategy，目标是想办法将钱催回。
 
@@ -272,28 +319,12 @@ def build_executor_system_prompt(org_name: str, memory_state: Dict[str, Any], st
 
 【要求】
 - 不提“我是AI”。
-- 语气需符合 `{pressure}` 等级。
-- 严禁违背 `guardrails`。
+- 语气需符合策略卡中 pressure_level 的等级。
+- 严禁违背策略卡中的 guardrails。
 - 每次只输出一条精简回复，不要长篇大论。
 """
 
 
-# =========================================================
-# LLM helpers
-# =========================================================
-# (omitted previous helpers for brevity if unchanged, but need to be careful with replace)
-
-# Note: I need to replace the call site too in the same file but it's far away.
-# Actually replace_file_content replaces a single contiguous block.
-# The definition is at ~185, and the call is at ~313. They are not contiguous.
-# I should use multi_replace_file_content or just do the definition first.
-
-# Let's fix the definition first.
-# Wait, simply changing signature here won't work because I cannot change the call site in the same replace_file_content if they are far apart.
-# I will use multi_replace_file_content.
-
-
-
 def build_history_summarizer_system_prompt() -> str:
     return """你是催收历史记录摘要器。请把用户粘贴的“过往追款记录（纯文本）”压缩成给催收对话使用的简明摘要。
 要求：
@@ -308,8 +339,14 @@ def build_history_summarizer_system_prompt() -> str:
 # =========================================================
 # LLM helpers
 # =========================================================
+def _throttle(system: str, user: str):
+    """请求前过一遍全局限速器：推测执行会成对并发发请求，突发不能超过账号 RPM/TPM。"""
+    get_rate_limiter().acquire(estimate_tokens(system) + estimate_tokens(user))
+
+
 def call_llm_text(system: str, user: str, temperature: float = 0.2) -> str:
     # temperature arg is kept in signature for compatibility but ignored in call
+    _throttle(system, user)
     resp = client.responses.create(
         model=MODEL,
         input=[
@@ -321,6 +358,34 @@ def call_llm_text(system: str, user: str, temperature: float = 0.2) -> str:
     return resp.output_text.strip()
 
 
+def call_llm_text_stream(system: str, user: str):
+    """流式版 call_llm_text：请求在函数体内立刻发出（便于丢进工作线程提前起跑），
+    返回的生成器逐段产出增量文本，供 st.write_stream 消费。"""
+    _throttle(system, user)
+    try:
+        stream = client.responses.create(
+            model=MODEL,
+            input=[
+                {"role": "system", "content": system},
+                {"role": "user", "content": user},
+            ],
+            stream=True,
+        )
+    except Exception as e:
+        def _err():
+            yield f"LLM Error: {e}"
+        return _err()
+
+    def _gen():
+        try:
+            for event in stream:
+                if event.type == "response.output_text.delta":
+                    yield event.delta
+        except Exception as e:
+            yield f"\nLLM Error: {e}"
+    return _gen()
+
+
 def build_history_summary(raw_text: str) -> str:
     raw_text = (raw_text or "").strip()
     if not raw_text:
@@ -329,9 +394,25 @@ def build_history_summary(raw_text: str) -> str:
     return call_llm_text(system, raw_text, temperature=0.0)
 
 
+def build_history_summary_incremental(old_summary: str, delta: str) -> str:
+    """增量摘要：只把新粘贴的片段交给模型，与既有摘要合并。
+
+    历史会越积越长，每次导入都整段重摘要的成本无上界；已摘要过的内容
+    不再重发，token 消耗只随新增片段增长。"""
+    delta = (delta or "").strip()
+    if not delta:
+        return old_summary or ""
+    if not old_summary:
+        return build_history_summary(delta)
+    system = (build_history_summarizer_system_prompt()
+              + "\n用户会提供【已有摘要】与【新增记录】两段，请合并成一份更新后的摘要"
+                "（失约次数取两者累计值，仍在末尾单独一行输出）。")
+    user = f"【已有摘要】\n{old_summary}\n\n【新增记录】\n{delta}"
+    return call_llm_text(system, user, temperature=0.0)
+
+
 def extract_broken_promises_from_summary(summary: str) -> int:
     """从 history_summary 中提取失约次数"""
-    import re
     if not summary:
         return 0
     
@@ -346,30 +427,31 @@ def extract_broken_promises_from_summary(summary: str) -> int:
 def clean_json_str(text: str) -> str:
     """Helper to remove markdown code blocks from JSON string."""
     text = text.strip()
-    if text.startswith("```"):
-        # Remove first line (e.g. ```json)
-        text = text.split("\n", 1)[1]
-    if text.endswith("```"):
-        text = text.rsplit("```", 1)[0]
-    return text.strip()
+    text = text.removeprefix("```json").removeprefix("```")
+    return text.removesuffix("```").strip()
+
+
+# Critic/Meta 的 system 提示词是纯常量，构建一次复用（同样为了 prompt caching）
+CRITIC_SYSTEM_PROMPT = build_critic_system_prompt()
+META_SYSTEM_PROMPT = build_meta_system_prompt()
 
 
 def call_critic(strategy_card: Dict[str, Any], memory_state: Dict[str, Any], dialogue: List[Dict[str, str]], history_summary: str) -> CriticResult:
-    system = build_critic_system_prompt()
+    system = CRITIC_SYSTEM_PROMPT
     payload = {
         "strategy_card": strategy_card,
         "memory_state": memory_state,
         "history_summary": history_summary,
-        "recent_dialogue": dialogue[-12:],
+        "recent_dialogue": dialogue,
     }
-    user = "请评估并输出JSON：\n" + json.dumps(payload, ensure_ascii=False)
+    user = "请评估并输出JSON：\n" + _dumps(payload)
 
     # Use simple text generation + manual parse
     try:
         txt = call_llm_text(system, user, temperature=0.0)
         clean_txt = clean_json_str(txt)
-        data = json.loads(clean_txt)
-        return CriticResult(**data)
+        data = _loads(clean_txt)
+        return _CRITIC_ADAPTER.validate_python(data)
     except Exception as e:
         return CriticResult(
             decision="ESCALATE_TO_META",
@@ -379,21 +461,21 @@ def call_critic(strategy_card: Dict[str, Any], memory_state: Dict[str, Any], dia
         )
 
 
-def call_meta(memory_state: Dict[str, Any], critic: CriticResult, dialogue: List[Dict[str, str]], history_summary: str) -> Dict[str, Any]:
-    system = build_meta_system_prompt()
+def call_meta(memory_state: Dict[str, Any], critic_dump: Dict[str, Any], dialogue: List[Dict[str, str]], history_summary: str) -> Dict[str, Any]:
+    system = META_SYSTEM_PROMPT
     payload = {
         "memory_state": memory_state,
-        "critic_result": critic.model_dump(),
+        "critic_result": critic_dump,
         "history_summary": history_summary,
-        "recent_dialogue": dialogue[-12:],
+        "recent_dialogue": dialogue,
     }
-    user = "请生成新的strategy_card JSON：\n" + json.dumps(payload, ensure_ascii=False)
+    user = "请生成新的strategy_card JSON：\n" + _dumps(payload)
 
     try:
         txt = call_llm_text(system, user, temperature=0.0)
         clean_txt = clean_json_str(txt)
-        data = json.loads(clean_txt)
-        sc = StrategyCard(**data)
+        data = _loads(clean_txt)
+        sc = _STRATEGY_ADAPTER.validate_python(data)
 
         # Hard alignment: stage must match memory_state.stage
         forced_stage = memory_state.get("stage")
@@ -404,11 +486,9 @@ def call_meta(memory_state: Dict[str, Any], critic: CriticResult, dialogue: List
         return sc.model_dump()
 
     except Exception as e:
-        # Log the error for debugging
-        import traceback
-        error_detail = traceback.format_exc()
-        print(f"[META ERROR] {error_detail}")  # This will show in terminal
-        
+        # 懒惰格式化：未开日志时不付 traceback 格式化与 stdout 刷写的成本
+        log.exception("meta_call_failed")
+
         dpd = int(memory_state.get("dpd", 0))
         stage = memory_state.get("stage", dpd_to_stage(dpd))
         fallback = StrategyCard(
@@ -425,19 +505,69 @@ def call_meta(memory_state: Dict[str, Any], critic: CriticResult, dialogue: List
         return fallback.model_dump()
 
 
-def call_executor(strategy_card: Dict[str, Any], memory_state: Dict[str, Any], dialogue: List[Dict[str, str]], micro: MicroEdits, history_summary: str) -> str:
+# call_executor 的粗粒度响应缓存：同一 (阶段, 施压等级, 问法, DPD 段) 下重复出现的
+# 用户短语（"没钱"/"明天还"/"工资没发" 等高频重复）直接复用上次生成的话术，
+# 整轮省掉一次 chat.completions 往返。提案里的 embedding 语义缓存需要额外的
+# numpy/嵌入依赖，这里按仓库既有的精确键缓存模式近似，命中面小一些但零成本。
+# 缓存本体放在 st.cache_resource：Streamlit 每次 rerun 都在新命名空间重跑主脚本，
+# 模块级 dict 会被清空，跨轮命中必须挂在进程级资源上。
+_EXEC_CACHE_TTL = 24 * 3600
+_EXEC_CACHE_MAX = 512
+
+
+@st.cache_resource(show_spinner=False)
+def get_exec_cache() -> Dict[str, tuple]:
+    return {}
+
+
+def _exec_cache_key(strategy_card: Dict[str, Any], memory_state: Dict[str, Any],
+                    micro: MicroEdits, last_user_msg: str) -> str:
+    dpd_band = int(memory_state.get("dpd", 0)) // 3
+    return "|".join((
+        strategy_card.get("stage", ""),
+        strategy_card.get("pressure_level", ""),
+        micro.ask_style,
+        str(dpd_band),
+        " ".join((last_user_msg or "").split()).lower(),
+    ))
+
+
+def call_executor_stream(strategy_card: Dict[str, Any], memory_state: Dict[str, Any], dialogue: List[Dict[str, str]], micro: MicroEdits, history_summary: str):
+    """返回逐段产出话术的生成器；缓存命中时一次性产出整条旧回复。"""
+    last_user_msg = dialogue[-1]["content"] if dialogue else ""
+    cache_key = _exec_cache_key(strategy_card, memory_state, micro, last_user_msg)
+    cache = get_exec_cache()
+    cached = cache.get(cache_key)
+    if cached is not None and time.time() - cached[1] < _EXEC_CACHE_TTL:
+        def _replay():
+            yield cached[0]
+        return _replay()
+
     org_name = memory_state.get("organization_name", "[机构名]")
-    # Updated call with new signature
-    system = build_executor_system_prompt(org_name, memory_state, strategy_card, history_summary)
+    context = build_executor_context(org_name, memory_state, strategy_card, history_summary)
     payload = {
         "strategy_card": strategy_card,
         "memory_state": memory_state,
         "history_summary": history_summary,
         "micro_edits": micro.model_dump(),
-        "recent_dialogue": dialogue[-12:],
+        "recent_dialogue": dialogue,
     }
-    user = "请基于以下信息生成下一条发给用户的话术：\n" + json.dumps(payload, ensure_ascii=False)
-    return call_llm_text(system, user, temperature=0.2)
+    user = context + "\n请基于以下信息生成下一条发给用户的话术：\n" + _dumps(payload)
+    chunks = call_llm_text_stream(EXECUTOR_STATIC_SYSTEM_PROMPT, user)
+
+    def _gen():
+        parts = []
+        for piece in chunks:
+            parts.append(piece)
+            yield piece
+        reply = "".join(parts).strip()
+        # 出错的半截回复不进缓存
+        if reply and not reply.startswith("LLM Error"):
+            if len(cache) >= _EXEC_CACHE_MAX:
+                # 插入序即时间序，淘汰最老的一条
+                cache.pop(next(iter(cache)))
+            cache[cache_key] = (reply, time.time())
+    return _gen()
 
 
 # =========================================================
@@ -446,37 +576,39 @@ def call_executor(strategy_card: Dict[str, Any], memory_state: Dict[str, Any], d
 def apply_memory_write(memory: Dict[str, Any], memory_write: Dict[str, Any]) -> Dict[str, Any]:
     if not memory_write:
         return memory
-    merged = dict(memory)
-    for k, v in memory_write.items():
-        if isinstance(v, dict) and isinstance(merged.get(k), dict):
-            merged[k] = {**merged[k], **v}
-        else:
-            merged[k] = v
+    # Plain top-level overwrites are the majority: handle them with one
+    # C-level dict union, then patch the rare dict-into-dict keys on top.
+    nested = {k: v for k, v in memory_write.items()
+              if isinstance(v, dict) and isinstance(memory.get(k), dict)}
+    merged = memory | {k: v for k, v in memory_write.items() if k not in nested}
+    for k, v in nested.items():
+        merged[k] = memory[k] | v
     return merged
 
 
 def ensure_strategy_card(memory_state: Dict[str, Any], strategy_card: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    dpd = int(memory_state.get("dpd", 0))
+    bp = int(memory_state.get("broken_promises", 0))
+    pr = int(memory_state.get("payment_refusals", 0))
+    stage = memory_state.get("stage", calculate_stage(dpd, bp, pr))
+
+    # 单槽身份备忘：纯 UI 重跑（侧边栏每个键击）都会带同一张卡来重复校验，
+    # 同一对象且 stage 未变时直接返回，省掉每次的 Pydantic 校验
+    memo = st.session_state.get("_sc_memo")
+    if memo is not None and memo[0] is strategy_card and memo[1] == stage:
+        return strategy_card
+
     # If it's a non-empty dict, validate it AND check if stage matches
     if strategy_card and isinstance(strategy_card, dict) and len(strategy_card) > 0:
         try:
-            validated = StrategyCard(**strategy_card).model_dump()
-            # Check if the stage in strategy_card matches the current memory_state stage
-            # Use multi-factor calculation
-            dpd = int(memory_state.get("dpd", 0))
-            bp = int(memory_state.get("broken_promises", 0))
-            pr = int(memory_state.get("payment_refusals", 0))
-            current_stage = memory_state.get("stage", calculate_stage(dpd, bp, pr))
-            if validated.get("stage") == current_stage:
+            validated = _STRATEGY_ADAPTER.validate_python(strategy_card).model_dump()
+            if validated.get("stage") == stage:
+                st.session_state._sc_memo = (validated, stage)
                 return validated
             # Stage mismatch detected, fall through to regenerate
         except Exception:
             pass
 
-    dpd = int(memory_state.get("dpd", 0))
-    bp = int(memory_state.get("broken_promises", 0))
-    pr = int(memory_state.get("payment_refusals", 0))
-    stage = memory_state.get("stage", calculate_stage(dpd, bp, pr))
-
     # Stage-specific strategy design
     if stage == "Stage0":
         # 提前期：建立关系，正向激励
@@ -542,16 +674,82 @@ def ensure_strategy_card(memory_state: Dict[str, Any], strategy_card: Optional[D
             },
             params={"focus": "formal_escalation", "allow_partial": False, "full_compliance_mode": True}
         )
-    
-    return sc.model_dump()
+
+    result = sc.model_dump()
+    st.session_state._sc_memo = (result, stage)
+    return result
+
+
+# 确定性快路径能识别的极短确认回复
+_FAST_YES_PAT = re.compile(r"^(?:是|对|好|好的|可以|能|嗯)[。.!！~]?$")
+# 否定/拒付短语：明确拒绝"今天还款"或往后拖的高频短回复。
+# 按 CRITIC 提示词的口径，仅在 DPD>=0 时计入 payment_refusals
+_FAST_NO_PAT = re.compile(r"^(?:否|不|不行|不能|没钱|没有钱|付不了|还不了|明天(?:再说)?|下周|过几天)[吧。.!！~]?$")
+
+
+def try_fast_critic(memory_state: Dict[str, Any], dialogue: List[Dict[str, str]],
+                    strategy_card: Dict[str, Any]) -> Optional[CriticResult]:
+    """规则可判定的轮次直接构造 CriticResult，整轮省掉 Critic 的 LLM 往返。
+
+    命中面刻意保守：连续无回应、提前期默契续行、二元收敛下的"是"确认，
+    以及 DPD>=0 时的明确拒付短语——后者的计数规则完全确定
+    （payment_refusals + 1），可以放心由规则写 memory_write；
+    其余（含失约计数等需要上下文的判断）仍交给 LLM。"""
+    if int(memory_state.get("no_response_streak", 0)) >= 3:
+        return CriticResult.model_construct(
+            decision="HANDOFF",
+            decision_reason="fast_path: 连续3次触达无回应，转人工处置",
+            reason_codes=["no_response_streak"],
+            risk_flags=["no_response"],
+        )
+
+    if int(memory_state.get("dpd", 0)) < 0 and strategy_card.get("stage") == "Stage0":
+        return CriticResult.model_construct(
+            decision="CONTINUE",
+            decision_reason="fast_path: 提前期且策略卡为Stage0，按当前策略继续",
+            reason_codes=["pre_due_continue"],
+        )
+
+    last = (dialogue[-1]["content"] or "").strip() if dialogue else ""
+    if _FAST_YES_PAT.match(last):
+        # 用户对二元收敛问句给了肯定确认：直接指示 Executor 锁定金额/时间
+        return CriticResult.model_construct(
+            decision="ADAPT_WITHIN_STRATEGY",
+            decision_reason="fast_path: 用户明确肯定，收敛到金额/时间确认",
+            reason_codes=["user_confirmed"],
+            progress_events=["user_agreed_to_pay"],
+            micro_edits_for_executor=MicroEdits(
+                ask_style="binary", confirmation_format="amount_time_today"),
+        )
+
+    if _FAST_NO_PAT.match(last) and int(memory_state.get("dpd", 0)) >= 0:
+        # 确定性拒付：计数规则可以精确算出，Executor 收敛到二元问句
+        # （今天付 or 当天展期），是否升级由下一轮的 stage 重算决定
+        return CriticResult.model_construct(
+            decision="ADAPT_WITHIN_STRATEGY",
+            decision_reason="fast_path: 用户明确拒绝/推迟今天还款，计入拒付并二元收敛",
+            reason_codes=["payment_refusal"],
+            risk_flags=["refusal"],
+            memory_write={"payment_refusals": int(memory_state.get("payment_refusals", 0)) + 1},
+            micro_edits_for_executor=MicroEdits(
+                ask_style="binary", confirmation_format="amount_time_today"),
+        )
+    return None
 
 
 # =========================================================
 # Orchestrator (single turn)
 # =========================================================
+def append_dialogue(role: str, content: str):
+    """同时写入完整对话（UI/审计）与有界 recent 窗口（喂给 LLM）"""
+    msg = {"role": role, "content": content}
+    st.session_state.dialogue.append(msg)
+    st.session_state.dialogue_recent.append(msg)
+
+
 def handle_turn(user_msg: str):
     # Append user message
-    st.session_state.dialogue.append({"role": "user", "content": user_msg})
+    append_dialogue("user", user_msg)
 
     # Refresh stage by DPD every turn (now using multi-factor calculation)
     dpd = int(st.session_state.memory_state.get("dpd", 0))
@@ -569,45 +767,84 @@ def handle_turn(user_msg: str):
     # NEW: If it's a default strategy, try to get a better one from Meta immediately
     is_default = st.session_state.strategy_card.get("strategy_id", "").endswith("_default")
     
-    # 1) Critic (Gate)
-    critic = call_critic(
-        st.session_state.strategy_card,
-        st.session_state.memory_state,
-        st.session_state.dialogue,
-        st.session_state.history_summary
-    )
+    # 1) Critic (Gate)，同时推测性地并行预打 Executor：默认策略首轮必走 Meta，
+    #    不浪费一次推测；其余轮次若 Critic 判 CONTINUE 且无改动，直接采用草稿，
+    #    整轮耗时从两次 RTT 之和降到 max(t_critic, t_exec)
+    default_micro = MicroEdits()
+    spec_future = None
+    recent_dialogue = list(st.session_state.dialogue_recent)
+    if _SPECULATE and not is_default:
+        spec_future = get_worker_pool().submit(
+            call_executor_stream,
+            dict(st.session_state.strategy_card),
+            dict(st.session_state.memory_state),
+            recent_dialogue,
+            default_micro,
+            st.session_state.history_summary,
+        )
+
+    critic = try_fast_critic(
+        st.session_state.memory_state, recent_dialogue, st.session_state.strategy_card)
+    if critic is None:
+        critic = call_critic(
+            st.session_state.strategy_card,
+            st.session_state.memory_state,
+            recent_dialogue,
+            st.session_state.history_summary
+        )
     
     # If default strategy, force escalation to Meta even if Critic didn't ask (on the first turn)
     if is_default and critic.decision == "CONTINUE":
         critic.decision = "ESCALATE_TO_META"
         critic.decision_reason += " | Initial default strategy detected, forcing Meta-layer activation."
     
-    st.session_state.last_critic = critic.model_dump()
+    # model_dump 只走一遍模型树：UI 面板与 Meta payload 共用同一份
+    critic_dump = critic.model_dump()
+    st.session_state.last_critic = critic_dump
 
     # 2) Apply critic memory writes
     st.session_state.memory_state = apply_memory_write(st.session_state.memory_state, critic.memory_write)
 
     # 3) Meta rewrite strategy if needed
     if critic.decision == "ESCALATE_TO_META":
-        print(f"[DEBUG] Calling Meta layer... Current strategy_id: {st.session_state.strategy_card.get('strategy_id')}")
+        log.debug("Calling Meta layer, current strategy_id=%s", st.session_state.strategy_card.get("strategy_id"))
         new_strategy = call_meta(
             st.session_state.memory_state,
-            critic,
-            st.session_state.dialogue,
+            critic_dump,
+            recent_dialogue,
             st.session_state.history_summary
         )
-        print(f"[DEBUG] Meta returned strategy_id: {new_strategy.get('strategy_id')}")
+        log.debug("Meta returned strategy_id=%s", new_strategy.get("strategy_id"))
         st.session_state.strategy_card = new_strategy
 
-    # 4) Executor response
-    reply = call_executor(
-        st.session_state.strategy_card,
-        st.session_state.memory_state,
-        st.session_state.dialogue,
-        critic.micro_edits_for_executor,
-        st.session_state.history_summary
+    # 4) Executor response：Critic 没改任何输入时直接用推测草稿，否则作废重打
+    speculation_valid = (
+        spec_future is not None
+        and critic.decision == "CONTINUE"
+        and not critic.memory_write
+        and critic.micro_edits_for_executor == default_micro
     )
-    st.session_state.dialogue.append({"role": "assistant", "content": reply})
+    if speculation_valid:
+        reply_stream = spec_future.result()
+    else:
+        if spec_future is not None:
+            spec_future.cancel()
+        reply_stream = call_executor_stream(
+            st.session_state.strategy_card,
+            st.session_state.memory_state,
+            recent_dialogue,
+            critic.micro_edits_for_executor,
+            st.session_state.history_summary
+        )
+
+    # 流式渲染：首 token 即上屏，感知时延从整条生成时间降到首 token 时间；
+    # 占位符在 rerun 前清掉，最终文本仍由上方的对话列表统一渲染
+    slot = st.empty()
+    with slot.container():
+        st.markdown("**机构（生成中）：**")
+        reply = st.write_stream(reply_stream)
+    slot.empty()
+    append_dialogue("assistant", str(reply))
 
 
 # =========================================================
@@ -633,6 +870,10 @@ if "memory_state" in st.session_state:
 
 if "dialogue" not in st.session_state:
     st.session_state.dialogue = []
+if "dialogue_recent" not in st.session_state:
+    # 有界窗口：O(1) 追加，传给 LLM 时 O(12) 拷贝，长会话不随历史变慢
+    st.session_state.dialogue_recent = deque(st.session_state.dialogue[-DIALOGUE_WINDOW:],
+                                             maxlen=DIALOGUE_WINDOW)
 if "memory_state" not in st.session_state:
     st.session_state.memory_state = {
         "customer_id": "C-demo",
@@ -687,13 +928,14 @@ with left:
 
     with c2:
         if st.button("模拟：用户不回应（仅记录）"):
-            st.session_state.dialogue.append({"role": "assistant", "content": "（系统记录：本次触达用户未回应）"})
+            append_dialogue("assistant", "（系统记录：本次触达用户未回应）")
             st.session_state.memory_state["no_response_streak"] = int(st.session_state.memory_state.get("no_response_streak", 0)) + 1
             st.rerun()
 
     with c3:
         if st.button("清空对话"):
             st.session_state.dialogue = []
+            st.session_state.dialogue_recent = deque(maxlen=DIALOGUE_WINDOW)
             st.session_state.last_critic = None
             st.rerun()
 
@@ -714,10 +956,12 @@ with right:
                     st.session_state.history_events.append({
                         "source": "manual_paste",
                         "text": txt,
-                        "imported_at": dt.datetime.now().isoformat()
+                        "imported_at": dt.datetime.now().isoformat(),
+                        "summarized": True,
                     })
-                    # regenerate (replace) summary from latest text
-                    summary = build_history_summary(txt)
+                    # 增量合并：只摘要新粘贴的片段，旧内容由已有 summary 承载
+                    summary = build_history_summary_incremental(
+                        st.session_state.history_summary, txt)
                     st.session_state.history_summary = summary
                     
                     # Auto-extract broken_promises from summary
@@ -769,29 +1013,35 @@ with right:
     st.session_state.strategy_card = ensure_strategy_card(st.session_state.memory_state, st.session_state.strategy_card)
     current_sc = st.session_state.strategy_card
     
-    # Strategy Card Visualization
-    with st.container(border=True):
-        # Debug: Show if strategy_card is empty or invalid
-        if not current_sc or not isinstance(current_sc, dict):
-            st.error("⚠️ Strategy Card is empty or invalid!")
-            st.json({"error": "strategy_card is None or not a dict", "value": str(current_sc)})
-        else:
-            st.markdown(f"**Strategy ID:** `{current_sc.get('strategy_id', 'Unknown')}`")
-            st.markdown(f"**当前阶段 (Stage):** `{current_sc.get('stage', 'Unknown')}`")
-            st.markdown(f"**施压等级 (Pressure):** `{current_sc.get('pressure_level', 'Unknown')}`")
-        
-        st.markdown("**📅 今日KPI (Today's KPI):**")
-        for kpi in current_sc.get('today_kpi', []):
-            st.markdown(f"- {kpi}")
-            
-        with st.expander("🛠️ 允许动作 (Allowed Actions)"):
-            st.write(", ".join(current_sc.get('allowed_actions', [])))
-            
-        with st.expander("🛡️ 合规/其他 (Guardrails & Params)"):
-            st.write("Guardrails:", current_sc.get('guardrails', []))
-            st.write("Params:", current_sc.get('params', {}))
-            if current_sc.get('notes'):
-                st.info(f"Notes: {current_sc.get('notes')}")
+    # Strategy Card Visualization：整卡拼成一段 markdown，一次 st.markdown 输出。
+    # 侧边栏每敲一个键都会触发整页重跑，把 6+ 个 widget 压成 1 个能明显降低重绘成本
+    if not current_sc or not isinstance(current_sc, dict):
+        st.error("⚠️ Strategy Card is empty or invalid!")
+        st.json({"error": "strategy_card is None or not a dict", "value": str(current_sc)})
+    else:
+        kpi_lines = "\n".join(f"- {kpi}" for kpi in current_sc.get('today_kpi', []))
+        notes = current_sc.get('notes')
+        notes_line = f"\n> Notes: {notes}" if notes else ""
+        card_md = f"""**Strategy ID:** `{current_sc.get('strategy_id', 'Unknown')}`  
+**当前阶段 (Stage):** `{current_sc.get('stage', 'Unknown')}`  
+**施压等级 (Pressure):** `{current_sc.get('pressure_level', 'Unknown')}`
+
+**📅 今日KPI (Today's KPI):**
+{kpi_lines}
+
+<details><summary>🛠️ 允许动作 (Allowed Actions)</summary>
+
+{", ".join(current_sc.get('allowed_actions', []))}
+</details>
+
+<details><summary>🛡️ 合规/其他 (Guardrails & Params)</summary>
+
+Guardrails: {", ".join(current_sc.get('guardrails', []))}
+
+Params: `{current_sc.get('params', {})}`{notes_line}
+</details>"""
+        with st.container(border=True):
+            st.markdown(card_md, unsafe_allow_html=True)
 
     st.subheader("🧐 门控判断 (Critic Observation)")
     critic_data = st.session_state.last_critic